@@ -0,0 +1,59 @@
+"""
+scaling benchmark of the cpu data-parallel training,
+train the Classifier on synthetic images with 1, 2, 4, 8 processes
+and print global throughput (images/sec)
+"""
+import os
+import sys
+import time
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+
+from train import Classifier, batch_size, free_port, setup
+
+warmup_steps = 3
+bench_steps = 20
+
+def bench_process(rank, world_size, queue):
+    setup(rank, world_size)
+    torch.manual_seed(rank)
+    local_batch = batch_size // world_size # global batch 固定，比較 strong scaling
+    x = torch.randn(local_batch, 3, 128, 128)
+    y = torch.randint(0, 11, (local_batch,))
+    model = DistributedDataParallel(Classifier())
+    loss = nn.CrossEntropyLoss()
+    optimizer = torch.optim.Adam(model.parameters(), lr=0.001)
+    model.train()
+    for step in range(warmup_steps + bench_steps):
+        if step == warmup_steps:
+            dist.barrier()
+            start = time.perf_counter()
+        optimizer.zero_grad()
+        loss(model(x), y).backward()
+        optimizer.step()
+    dist.barrier()
+    elapsed = time.perf_counter() - start
+    if rank == 0:
+        queue.put(elapsed)
+    dist.destroy_process_group()
+
+def bench(world_size):
+    ctx = mp.get_context('spawn')
+    queue = ctx.SimpleQueue()
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(free_port())
+    mp.spawn(bench_process, args=(world_size, queue), nprocs=world_size)
+    elapsed = queue.get()
+    return bench_steps * (batch_size // world_size) * world_size / elapsed
+
+if __name__ == "__main__":
+    procs = [int(n) for n in sys.argv[1:]] or [1, 2, 4, 8]
+    print('procs  img/s     speedup  efficiency')
+    base = None
+    for n in procs:
+        throughput = bench(n)
+        base = base or throughput
+        print('%5d  %8.1f  %7.2f  %9.1f%%' % (n, throughput, throughput / base, throughput / base / n * 100))
@@ -0,0 +1,4 @@
+#!/bin/bash
+# bash hw3_dist_train.sh <data directory> <number of processes>
+export OMP_NUM_THREADS=$(( $(nproc) / $2 > 0 ? $(nproc) / $2 : 1 ))
+python3 train.py $1 $2
@@ -0,0 +1,121 @@
+"""
+per-step profiler for the training loop
+record data-loading wait, forward, backward, optimizer time and images/sec,
+keep loss / accuracy on device and only sync at log boundaries,
+export the trace as json or csv
+"""
+import os
+import csv
+import json
+import time
+import torch
+import torch.distributed as dist
+
+class StepProfiler(object):
+    PHASES = ('data', 'forward', 'backward', 'optim')
+
+    def __init__(self, device, log_steps=50):
+        self.device = torch.device(device)
+        self.use_cuda = self.device.type == 'cuda'
+        self.log_steps = log_steps
+        self.rows = []      # 已經同步過的 per-step 紀錄
+        self.pending = []   # 還沒同步的 step (cuda event / loss tensor 都還在 device 上)
+        self.step = 0
+        self.epoch = 0
+        self.reset_epoch(0)
+
+    def reset_epoch(self, epoch):
+        # 每個 epoch 的 loss / correct 累加在 device 上，epoch 結束時才同步一次
+        self.epoch = epoch
+        self.loss_sum = torch.zeros((), device=self.device)
+        self.correct = torch.zeros((), dtype=torch.long, device=self.device)
+        self.n_images = 0
+        self.epoch_start = time.perf_counter()
+        self.last = time.perf_counter()
+
+    def _now(self):
+        # cuda 上用 event 記錄時間點，不會讓 host 等 GPU；cpu 上直接用 perf_counter
+        if self.use_cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    def begin(self):
+        # data loader 交出 batch 的瞬間，之前等待的時間就是 data wait
+        now = time.perf_counter()
+        self.cur = {'data': now - self.last, 'marks': [self._now()]}
+
+    def mark(self, phase):
+        assert phase in self.PHASES[1:]
+        self.cur['marks'].append(self._now())
+
+    def end(self, batch_size, loss, pred, label):
+        # loss / pred 都不 .item()，只在 device 上累加
+        loss = loss.detach()
+        self.loss_sum += loss * batch_size
+        self.correct += (pred.detach().argmax(1) == label).sum()
+        self.n_images += batch_size
+        self.cur.update(step=self.step, epoch=self.epoch, batch_size=batch_size, loss=loss)
+        self.pending.append(self.cur)
+        self.step += 1
+        if len(self.pending) >= self.log_steps:
+            self.flush()
+        self.last = time.perf_counter()
+
+    def flush(self):
+        # log boundary：同步一次，把 pending 的 step 轉成數字
+        if not self.pending:
+            return
+        if self.use_cuda:
+            torch.cuda.synchronize(self.device)
+        losses = torch.stack([p['loss'] for p in self.pending]).float().cpu().tolist()
+        for p, loss in zip(self.pending, losses):
+            marks = p['marks']
+            if self.use_cuda:
+                spans = [marks[i].elapsed_time(marks[i + 1]) / 1000 for i in range(len(marks) - 1)]
+            else:
+                spans = [marks[i + 1] - marks[i] for i in range(len(marks) - 1)]
+            row = {'step': p['step'], 'epoch': p['epoch'], 'batch_size': p['batch_size'], 'data': p['data']}
+            row.update(zip(self.PHASES[1:], spans))
+            row['step_time'] = sum(row[k] for k in self.PHASES)
+            row['img_per_sec'] = p['batch_size'] / row['step_time'] if row['step_time'] > 0 else 0.0
+            row['loss'] = loss
+            self.rows.append(row)
+        self.pending = []
+
+    def epoch_summary(self):
+        # 回傳 (秒數, acc, loss)，這裡同步一次；data-parallel 時先把各 rank 的累加值 allreduce
+        self.flush()
+        stats = torch.stack([self.loss_sum.double(), self.correct.double(),
+                             torch.tensor(float(self.n_images), dtype=torch.double, device=self.device)])
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(stats)
+        loss_sum, correct, n = stats.tolist()
+        n = max(n, 1)
+        acc = correct / n
+        loss = loss_sum / n
+        return time.perf_counter() - self.epoch_start, acc, loss
+
+    def summary(self):
+        # 整體各階段時間佔比，用來判斷是 input-bound 還是 compute-bound
+        self.flush()
+        total = {k: sum(r[k] for r in self.rows) for k in self.PHASES}
+        step_time = sum(total.values())
+        images = sum(r['batch_size'] for r in self.rows)
+        ret = {k + '_frac': (v / step_time if step_time > 0 else 0.0) for k, v in total.items()}
+        ret['img_per_sec'] = images / step_time if step_time > 0 else 0.0
+        ret['input_bound'] = ret['data_frac'] > 0.5
+        return ret
+
+    def export(self, path):
+        self.flush()
+        if os.path.splitext(path)[1] == '.csv':
+            fields = ['step', 'epoch', 'batch_size'] + list(self.PHASES) + ['step_time', 'img_per_sec', 'loss']
+            with open(path, 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=fields)
+                writer.writeheader()
+                writer.writerows(self.rows)
+        else:
+            with open(path, 'w') as f:
+                json.dump({'summary': self.summary(), 'steps': self.rows}, f)
@@ -0,0 +1,82 @@
+"""
+streaming image dataset for image folders too large to load into memory,
+images are decoded on demand in the data loader workers,
+each rank / worker always reads the same shard of files (shuffled within the shard every epoch),
+decoded images are kept in a bounded LRU cache
+and shuffled through a fixed-size buffer
+"""
+import os
+import random
+from collections import OrderedDict
+import numpy as np
+import cv2
+from torch.utils.data import IterableDataset, get_worker_info
+
+class StreamImgDataset(IterableDataset):
+    def __init__(self, dirs, label=True, transform=None, cache_size=1024, buffer_size=1024,
+                 seed=0, rank=0, world_size=1):
+        # 只存檔名跟 label，圖片等到 iterate 時才讀
+        self.files = []
+        for path in dirs:
+            self.files += [os.path.join(path, file) for file in sorted(os.listdir(path))]
+        self.label = label
+        if label:
+            self.y = np.array([int(os.path.basename(file).split("_")[0]) for file in self.files], dtype=np.int64)
+        self.transform = transform
+        self.cache_size = cache_size
+        self.buffer_size = buffer_size
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.cache = OrderedDict()
+        self.epoch = 0
+
+    def __len__(self):
+        # 每個 rank 分到的圖片數 (跟 DistributedSampler 一樣補齊成一樣多)
+        return (len(self.files) + self.world_size - 1) // self.world_size
+
+    def decode(self, index):
+        # LRU cache：命中就移到最後，滿了就丟掉最久沒用的
+        if index in self.cache:
+            self.cache.move_to_end(index)
+            return self.cache[index]
+        img = cv2.resize(cv2.imread(self.files[index]), (128, 128))
+        self.cache[index] = img
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return img
+
+    def item(self, index):
+        X = self.decode(index)
+        if self.transform is not None:
+            X = self.transform(X)
+        if self.label:
+            return X, self.y[index]
+        return X
+
+    def __iter__(self):
+        # worker 裡的 dataset 是複本，每次 iterate 自己把 epoch 加一，所有 rank / worker 都會同步
+        epoch = self.epoch
+        self.epoch += 1
+        worker = get_worker_info()
+        worker_id, num_workers = (worker.id, worker.num_workers) if worker is not None else (0, 1)
+
+        # 圖片依 index 固定分給各個 rank / worker (補齊的部分從頭重複)，每個 epoch 都是同一份
+        # 只在自己的 shard 裡打亂順序，LRU cache 裡的圖片下個 epoch 還會用到
+        shard = np.arange(len(self) * self.world_size) % len(self.files)
+        shard = shard[self.rank::self.world_size][worker_id::num_workers]
+        order = np.random.RandomState([self.seed, epoch, self.rank, worker_id]).permutation(shard)
+
+        rng = random.Random((self.seed + epoch) * 1000003 + self.rank * 1009 + worker_id)
+        buffer = []
+        for index in order:
+            if len(buffer) < self.buffer_size:
+                buffer.append(index)
+                continue
+            # buffer 滿了就隨機換出一張
+            j = rng.randrange(self.buffer_size)
+            yield self.item(buffer[j])
+            buffer[j] = index
+        rng.shuffle(buffer)
+        for index in buffer:
+            yield self.item(index)
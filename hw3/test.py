@@ -9,6 +9,7 @@ import cv2
 import os
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torchvision.transforms as transforms
 import pandas as pd
 from torch.utils.data import DataLoader, Dataset
@@ -16,6 +17,10 @@ from torch.utils.data import DataLoader, Dataset
 workspace_dir = sys.argv[1]
 output_f = sys.argv[2]
 model_f = "./model.pkl"
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+tta = False # test-time augmentation：原圖、水平翻轉、四角與中央的 crop 一起丟進 model 平均 logits
+tta_crop = 112 # crop 大小，crop 完再縮放回 128
+tta_batch_size = 32 # 開 tta 時一個 batch 會變成 7 倍的圖片
 
 def readfile(path, label):
     # label 是一個 boolean variable，代表需不需要回傳 y 值
@@ -59,6 +64,16 @@ class ImgDataset(Dataset):
         else:
             return X
 
+def tta_views(x):
+    # x = [batch size, 3, 128, 128] -> [7 * batch size, 3, 128, 128]
+    # 所有 view 接成一個 batch，只需要做一次 forward
+    size = x.size(2)
+    o = size - tta_crop
+    m = o // 2
+    crops = [x[:, :, i:i + tta_crop, j:j + tta_crop] for i, j in [(0, 0), (0, o), (o, 0), (o, o), (m, m)]]
+    crops = F.interpolate(torch.cat(crops), size=(size, size), mode='bilinear', align_corners=False)
+    return torch.cat((x, x.flip(3), crops))
+
 class Classifier(nn.Module):
     def __init__(self):
         super(Classifier, self).__init__()
@@ -112,22 +127,28 @@ if __name__ == "__main__":
     # read testing set
     test_x = readfile(os.path.join(workspace_dir, "testing"), False)
 
-    batch_size = 128
+    batch_size = tta_batch_size if tta else 128
     test_set = ImgDataset(test_x, transform=test_transform)
     test_loader = DataLoader(test_set, batch_size=batch_size, shuffle=False)
 
     print("load model")
-    model_best = torch.load(model_f)
+    model_best = torch.load(model_f, map_location=device)
     model_best.eval()
-    prediction = []
+    # 預先配置好存 prediction 的空間，結果留在 device 上最後才一次搬回來
+    prediction = torch.empty(len(test_set), dtype=torch.long, device=device)
     
     print("training")
     with torch.no_grad():
+        start = 0
         for i, data in enumerate(test_loader):
-            test_pred = model_best(data.cuda())
-            test_label = np.argmax(test_pred.cpu().data.numpy(), axis=1)
-            for y in test_label:
-                prediction.append(y)
+            data = data.to(device)
+            if tta:
+                test_pred = model_best(tta_views(data)).view(-1, data.size(0), 11).mean(0)
+            else:
+                test_pred = model_best(data)
+            prediction[start:start + data.size(0)] = test_pred.argmax(1)
+            start += data.size(0)
+    prediction = prediction.cpu().tolist()
     #將結果寫入 csv 檔
     with open(output_f, 'w') as f:
         f.write('Id,Category\n')
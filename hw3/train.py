@@ -7,16 +7,34 @@ import sys
 import numpy as np
 import cv2
 import os
+import socket
 import torch
 import torch.nn as nn
+import torch.distributed as dist
+import torch.multiprocessing as mp
 import torchvision.transforms as transforms
 import pandas as pd
 from torch.utils.data import DataLoader, Dataset
+from torch.utils.data.distributed import DistributedSampler
+from torch.nn.parallel import DistributedDataParallel
 # import time
 # import matplotlib.pyplot as plt
+from profiler import StepProfiler
+from stream_data import StreamImgDataset
 
 model_f = "./model.pkl"
-workspace_dir = sys.argv[1]
+model_state_f = "./model_state.pkl" # data-parallel 時 rank 0 存的 state_dict
+cache_x_f = "./train_val_x.npy" # data-parallel 時各 process 共用的圖片 cache (memory-mapped)
+cache_y_f = "./train_val_y.npy"
+trace_f = "./train_trace.json" # per-step 時間紀錄，副檔名為 .csv 時輸出 csv
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+log_steps = 50 # 每幾個 step 才同步一次 device 上的數據
+batch_size = 128 # global batch size，data-parallel 時平均分給每個 process
+num_epoch = 120
+stream = False # True 時不預先讀入所有圖片，改成訓練時在 worker 裡逐張解碼 (記憶體放不下整個資料集時使用)
+stream_workers = 4
+stream_cache_size = 1024 # 每個 worker 保留的已解碼圖片數
+stream_buffer_size = 1024 # shuffle buffer 大小
 
 def readfile(path, label):
     # label 是一個 boolean variable，代表需不需要回傳 y 值
@@ -116,51 +134,118 @@ class Classifier(nn.Module):
         out = out.view(out.size()[0], -1)
         return self.fc(out)
 
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def setup(rank, world_size):
+    # 每個 process 只用自己那份 cpu core，避免 thread 互搶
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+
+def train_process(rank, world_size, workspace_dir, train_val_x=None, train_val_y=None):
+    # world_size > 1 時是 gloo backend 的 cpu data-parallel，每個 process 從 cache 讀同一份圖片
+    distributed = world_size > 1
+    dev = torch.device("cpu") if distributed else device
+    if distributed:
+        setup(rank, world_size)
+    sampler = None
+    if stream:
+        dirs = [os.path.join(workspace_dir, "training"), os.path.join(workspace_dir, "validation")]
+        train_val_set = StreamImgDataset(dirs, True, train_transform, stream_cache_size, stream_buffer_size,
+                                         rank=rank, world_size=world_size)
+        train_val_loader = DataLoader(train_val_set, batch_size=batch_size // world_size, num_workers=stream_workers,
+                                      persistent_workers=stream_workers > 0)
+    else:
+        if distributed:
+            train_val_x, train_val_y = np.load(cache_x_f, mmap_mode='r'), np.load(cache_y_f)
+        train_val_set = ImgDataset(train_val_x, train_val_y, train_transform)
+        if distributed:
+            sampler = DistributedSampler(train_val_set, num_replicas=world_size, rank=rank, shuffle=True)
+        train_val_loader = DataLoader(train_val_set, batch_size=batch_size // world_size, shuffle=(sampler is None), sampler=sampler)
+
+    # train
+    model_best = Classifier().to(dev)
+    if distributed:
+        model_best = DistributedDataParallel(model_best) # backward 時 allreduce gradient
+    loss = nn.CrossEntropyLoss() # 因為是 classification task，所以 loss 使用 CrossEntropyLoss
+    optimizer = torch.optim.Adam(model_best.parameters(), lr=0.001) # optimizer 使用 Adam
+    profiler = StepProfiler(dev, log_steps)
+
+    for epoch in range(num_epoch):
+        profiler.reset_epoch(epoch)
+        if sampler is not None:
+            sampler.set_epoch(epoch)
+
+        model_best.train()
+        for i, data in enumerate(train_val_loader):
+            profiler.begin()
+            inputs, labels = data[0].to(dev), data[1].to(dev)
+            optimizer.zero_grad()
+            train_pred = model_best(inputs)
+            batch_loss = loss(train_pred, labels)
+            profiler.mark('forward')
+            batch_loss.backward()
+            profiler.mark('backward')
+            optimizer.step()
+            profiler.mark('optim')
+            profiler.end(inputs.size(0), batch_loss, train_pred, labels)
+
+        #將結果 print 出來
+        epoch_time, train_acc, train_loss = profiler.epoch_summary()
+        if rank == 0:
+            print('[%03d/%03d] %2.2f sec(s) Train Acc: %3.6f Loss: %3.6f' % \
+              (epoch + 1, num_epoch, epoch_time, train_acc, train_loss))
+
+    if distributed:
+        model_best = model_best.module
+    if rank == 0:
+        summary = profiler.summary()
+        print('%.1f img/s (rank 0), data wait %.1f%%, forward %.1f%%, backward %.1f%%, optim %.1f%%' % \
+          (summary['img_per_sec'], summary['data_frac'] * 100, summary['forward_frac'] * 100, \
+          summary['backward_frac'] * 100, summary['optim_frac'] * 100))
+        profiler.export(trace_f)
+        if distributed:
+            torch.save(model_best.state_dict(), model_state_f)
+    if distributed:
+        dist.destroy_process_group()
+    return model_best
+
 if __name__ == "__main__":
-  # read file
-  train_x, train_y = readfile(os.path.join(workspace_dir, "training"), True)
-  val_x, val_y = readfile(os.path.join(workspace_dir, "validation"), True)
-
-  # transform
-  batch_size = 128 
-  # train_set = ImgDataset(train_x, train_y, train_transform)
-  # val_set = ImgDataset(val_x, val_y, test_transform)
-  # train_loader = DataLoader(train_set, batch_size=batch_size, shuffle=True)
-  # val_loader = DataLoader(val_set, batch_size=batch_size, shuffle=False)
-
-  # combine train set and validation set
-  train_val_x = np.concatenate((train_x, val_x), axis=0)
-  train_val_y = np.concatenate((train_y, val_y), axis=0)
-  train_val_set = ImgDataset(train_val_x, train_val_y, train_transform)
-  train_val_loader = DataLoader(train_val_set, batch_size=batch_size, shuffle=True)
-  
-  # train
-  model_best = Classifier().cuda()
-  loss = nn.CrossEntropyLoss() # 因為是 classification task，所以 loss 使用 CrossEntropyLoss
-  optimizer = torch.optim.Adam(model_best.parameters(), lr=0.001) # optimizer 使用 Adam
-  num_epoch = 120
-
-  for epoch in range(num_epoch):
-      epoch_start_time = time.time()
-      train_acc = 0.0
-      train_loss = 0.0
-
-      model_best.train()
-      for i, data in enumerate(train_val_loader):
-          optimizer.zero_grad()
-          train_pred = model_best(data[0].cuda())
-          batch_loss = loss(train_pred, data[1].cuda())
-          batch_loss.backward()
-          optimizer.step()
-
-          train_acc += np.sum(np.argmax(train_pred.cpu().data.numpy(), axis=1) == data[1].numpy())
-          train_loss += batch_loss.item()
-
-          #將結果 print 出來
-      # print('[%03d/%03d] %2.2f sec(s) Train Acc: %3.6f Loss: %3.6f' % \
-      #   (epoch + 1, num_epoch, time.time()-epoch_start_time, \
-      #   train_acc/train_val_set.__len__(), train_loss/train_val_set.__len__()))
-  
+  workspace_dir = sys.argv[1]
+  num_procs = int(sys.argv[2]) if len(sys.argv) > 2 else 1 # data-parallel 的 process 數
+
+  train_val_x, train_val_y = None, None
+  if not stream:
+    # read file
+    train_x, train_y = readfile(os.path.join(workspace_dir, "training"), True)
+    val_x, val_y = readfile(os.path.join(workspace_dir, "validation"), True)
+
+    # transform
+    # train_set = ImgDataset(train_x, train_y, train_transform)
+    # val_set = ImgDataset(val_x, val_y, test_transform)
+    # train_loader = DataLoader(train_set, batch_size=batch_size, shuffle=True)
+    # val_loader = DataLoader(val_set, batch_size=batch_size, shuffle=False)
+
+    # combine train set and validation set
+    train_val_x = np.concatenate((train_x, val_x), axis=0)
+    train_val_y = np.concatenate((train_y, val_y), axis=0)
+    del train_x, val_x
+
+  if num_procs > 1:
+      if not stream:
+          np.save(cache_x_f, train_val_x)
+          np.save(cache_y_f, train_val_y)
+          train_val_x, train_val_y = None, None
+      os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+      os.environ.setdefault('MASTER_PORT', str(free_port()))
+      mp.spawn(train_process, args=(num_procs, workspace_dir), nprocs=num_procs)
+      # 在主 process 重新建 model 再存，讓 model.pkl 跟單機訓練的一樣可以被 test.py 讀取
+      model_best = Classifier()
+      model_best.load_state_dict(torch.load(model_state_f))
+  else:
+      model_best = train_process(0, 1, workspace_dir, train_val_x, train_val_y)
+
   # save model
   torch.save(model_best, model_f)
-
@@ -0,0 +1,101 @@
+"""
+throughput benchmark of the sentiment models on cpu,
+feed synthetic token batches (random lengths) against a synthetic embedding matrix,
+measure forward and forward + backward tweets/sec, memory and parameter counts
+for each architecture, hidden_dim, num_layers, sen_len and batch size
+usage: python3 bench.py [--arch bi_LSTM_Net GRU_Net ...] [--hidden_dim 150 ...] [--num_layers 1 ...] [--sen_len 35 ...] [--batch_size 128 ...]
+"""
+import sys
+import time
+import argparse
+import contextlib
+import itertools
+import torch
+from torch import nn
+
+sys.path.append("./src")
+import model as models
+sys.path.pop()
+
+vocab_size = 50000 # 跟 w2v_all.model 的字典差不多大
+embedding_dim = 250
+warmup_steps = 2
+
+def synthetic_batch(batch_size, sen_len):
+    # 長度在 1 到 sen_len 之間的句子，後面補 <PAD> (index 0)
+    lengths = torch.randint(1, sen_len + 1, (batch_size,))
+    inputs = torch.randint(1, vocab_size, (batch_size, sen_len))
+    inputs[torch.arange(sen_len)[None, :] >= lengths[:, None]] = 0
+    labels = torch.randint(0, 2, (batch_size,)).float()
+    return inputs, lengths, labels
+
+class SavedMemory():
+    # 用在 with 裡：forward 時 autograd 留給 backward 的 tensor 總大小 (bytes)
+    # 同一塊 storage (例如 view) 只算一次，model 的參數不算
+    def __init__(self, model):
+        self.skip = {p.untyped_storage().data_ptr() for p in model.parameters()}
+        self.storages = {}
+        self.hooks = torch.autograd.graph.saved_tensors_hooks(self.pack, lambda t: t)
+    def pack(self, t):
+        storage = t.untyped_storage()
+        if storage.data_ptr() not in self.skip:
+            self.storages[storage.data_ptr()] = storage.nbytes()
+        return t
+    def __enter__(self):
+        self.hooks.__enter__()
+        return self
+    def __exit__(self, *args):
+        self.hooks.__exit__(*args)
+    def total(self):
+        return sum(self.storages.values())
+
+def bench(arch, hidden_dim, num_layers, sen_len, batch_size, steps, embedding):
+    model = getattr(models, arch)(embedding, embedding_dim, hidden_dim, num_layers, dropout=0.5, fix_embedding=True)
+    criterion = nn.BCELoss()
+    batch = synthetic_batch(batch_size, sen_len)
+    params = sum(p.numel() for p in model.parameters() if p is not model.embedding.weight)
+
+    # forward
+    model.eval()
+    with torch.no_grad():
+        for step in range(warmup_steps + steps):
+            if step == warmup_steps:
+                start = time.perf_counter()
+            model(batch[0], batch[1])
+    forward = steps * batch_size / (time.perf_counter() - start)
+
+    # forward + backward
+    # 第一個 warmup step 順便記錄 backward 需要的記憶體
+    model.train()
+    saved = SavedMemory(model)
+    for step in range(warmup_steps + steps):
+        if step == warmup_steps:
+            start = time.perf_counter()
+        model.zero_grad()
+        with saved if step == 0 else contextlib.nullcontext():
+            loss = criterion(model(batch[0], batch[1]).view(-1), batch[2])
+        loss.backward()
+    backward = steps * batch_size / (time.perf_counter() - start)
+    return forward, backward, params, saved.total()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--arch', nargs='+', default=['LSTM_Net', 'bi_LSTM_Net', 'GRU_Net', 'CNN_Net'])
+    parser.add_argument('--hidden_dim', nargs='+', type=int, default=[150])
+    parser.add_argument('--num_layers', nargs='+', type=int, default=[1])
+    parser.add_argument('--sen_len', nargs='+', type=int, default=[35])
+    parser.add_argument('--batch_size', nargs='+', type=int, default=[128])
+    parser.add_argument('--steps', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=0) # 0 為 torch 預設
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    torch.manual_seed(0)
+    embedding = torch.randn(vocab_size, embedding_dim)
+    print('arch          hidden  layers  sen_len  batch  fwd tweets/s  fwd+bwd tweets/s  params(K)  activations(MB)')
+    for arch, hidden_dim, num_layers, sen_len, batch_size in itertools.product(
+            args.arch, args.hidden_dim, args.num_layers, args.sen_len, args.batch_size):
+        forward, backward, params, memory = bench(arch, hidden_dim, num_layers, sen_len, batch_size, args.steps, embedding)
+        print('%-12s  %6d  %6d  %7d  %5d  %12.1f  %16.1f  %9.1f  %15.1f' % \
+            (arch, hidden_dim, num_layers, sen_len, batch_size, forward, backward, params / 1000, memory / 2**20))
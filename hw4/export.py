@@ -0,0 +1,91 @@
+"""
+export the sentiment model for cpu inference,
+apply dynamic int8 quantization to the LSTM and the classifier Linear,
+trace it into a standalone TorchScript file (loaded without the code in ./src),
+compare tweets/sec and accuracy with the float32 model on the validation set
+usage: python3 export.py <training_label.txt>
+"""
+import io
+import os
+import sys
+import time
+import numpy as np
+import torch
+from torch import nn
+
+sys.path.append("./src")
+from token_store import TokenStore
+from preprocess import Preprocess
+from data import TwitterDataset, collate_batch
+sys.path.pop()
+from test import testing
+
+w2v_path = './w2v_all.model'
+model_f = "./ckpt_final.model"
+quantized_model_f = "./ckpt_int8.pt"
+embedding_f = "./embedding.npy"
+vocab_f = "./embedding_vocab.txt"
+cache_dir = "./cache"
+sen_len = 35
+batch_size = 128
+val_start = 180000 # 跟 main.py 相同，之後的句子是 validation set
+
+def quantize_model(model):
+    # dynamic int8 quantization：LSTM 跟 Linear 的權重存成 int8，activation 在執行時才動態量化，只能在 CPU 上執行
+    model = model.cpu().eval()
+    return torch.quantization.quantize_dynamic(model, {nn.LSTM, nn.Linear}, dtype=torch.qint8)
+
+def script_model(model, example):
+    # 用一個 batch 的資料 trace 成 TorchScript，batch 大小跟句子長度之後都可以不同
+    # (LSTM 初始的 hidden state 由 model 依 inputs.size(0) 產生，見 src/model.py 的 init_hidden)
+    with torch.no_grad():
+        return torch.jit.trace(model.eval(), example)
+
+def check_batch_sizes(traced, model, inputs, lengths):
+    # trace 時只看過一種 batch 大小，用其他大小 (1 句、不滿一個 batch) 確認結果跟原本的 model 相同
+    with torch.no_grad():
+        for n in (1, inputs.size(0) // 4, inputs.size(0)):
+            expected = model(inputs[:n], lengths[:n])
+            if not torch.allclose(traced(inputs[:n], lengths[:n]), expected, atol=1e-6):
+                raise RuntimeError("traced model differs from the original model at batch size {}".format(n))
+
+def model_size(model):
+    # TorchScript 檔案的大小 (MB)
+    buffer = io.BytesIO()
+    torch.jit.save(model, buffer)
+    return buffer.tell() / 2**20
+
+if __name__ == "__main__":
+    store = TokenStore(sys.argv[1], 'label', cache_dir)
+    preprocess = Preprocess(store, sen_len, w2v_path=w2v_path)
+    if os.path.exists(embedding_f) and os.path.exists(vocab_f):
+        preprocess.load_embedding(embedding_f, vocab_f)
+    else:
+        preprocess.make_embedding(load=True)
+        preprocess.save_embedding(embedding_f, vocab_f)
+    x = preprocess.sentence_word2idx(cache_dir)[val_start:]
+    y = store.labels[val_start:]
+    val_dataset = TwitterDataset(X=x, y=None, lengths=preprocess.sequence_lengths(x))
+    val_loader = torch.utils.data.DataLoader(dataset = val_dataset,
+                                             batch_size = batch_size,
+                                             shuffle = False,
+                                             collate_fn = collate_batch)
+
+    model = torch.load(model_f, map_location='cpu')
+    inputs, lengths = next(iter(val_loader))
+    example = (inputs.long(), lengths)
+    float_model = script_model(model, example)
+    int8_model = script_model(quantize_model(model), example)
+    *_, last = val_loader # 最後一個 batch 通常不滿 batch_size 句
+    for traced, m in ((float_model, model), (int8_model, quantize_model(model))):
+        check_batch_sizes(traced, m.eval(), last[0].long(), last[1])
+    torch.jit.save(int8_model, quantized_model_f)
+    print("save int8 model at {}".format(quantized_model_f))
+
+    print('model    tweets/s   acc      size(MB)')
+    for name, m in (('float32', float_model), ('int8', int8_model)):
+        start = time.perf_counter()
+        outputs = testing(batch_size, val_loader, m, torch.device("cpu"))
+        elapsed = time.perf_counter() - start
+        acc = np.mean(np.array(outputs) == y)
+        print('%-7s  %8.1f  %.5f  %8.1f' % (name, len(val_dataset) / elapsed, acc, model_size(m)))
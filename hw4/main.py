@@ -10,10 +10,11 @@ from gensim.models import word2vec
 
 sys.path.append("./src")
 from utils import load_training_data, load_testing_data
+from token_store import TokenStore
 from preprocess import Preprocess
 from model import bi_LSTM_Net
-from data import TwitterDataset
-from train import training
+from data import TwitterDataset, BucketBatchSampler, collate_batch
+from train import training, pseudo_labeling
 sys.path.pop()
 
 # 通過 torch.cuda.is_available() 的回傳值進行判斷是否有使用 GPU 的環境，如果有的話 device 就設為 "cuda"，沒有的話就設為 "cpu"
@@ -25,6 +26,13 @@ train_no_label = sys.argv[2]
 w2v_path = './w2v_all.model' # 處理 word to vec model 的路徑
 
 model_f = "./ckpt_final.model"
+metrics_f = "./train_metrics.json" # 訓練過程的 loss / accuracy，一行一個 json
+log_steps = 50 # 每幾個 batch 才同步一次 device 上的 loss / accuracy
+log_interval = 1.0 # 兩次 print 之間至少間隔幾秒
+embedding_f = "./embedding.npy" # 從 w2v model 取出的 embedding 跟字典，test.py 直接讀取這兩個檔案
+vocab_f = "./embedding_vocab.txt"
+cache_dir = "./cache" # token store 跟句子轉成 index 的結果存放的位置
+index_workers = 4 # 句子轉成 index 時平行的 process 數
 
 # 定義句子長度、要不要固定 embedding、batch 大小、要訓練幾個 epoch、learning rate 的值、model 的資料夾路徑
 sen_len = 35 #20
@@ -32,17 +40,25 @@ fix_embedding = True # fix embedding during training
 batch_size = 128
 epoch = 10
 lr = 0.001
-# threshold = 0.05 # self-training
+# self-training：每一輪用目前最好的模型標記 training_nolabel，機率 <= threshold 或 >= 1 - threshold 的句子加進 training data 再訓練
+self_train_rounds = 2
+threshold = 0.05
+self_train_epoch = 3
+pseudo_chunk_size = 100000 # 一次讀多少句沒有 label 的句子
+pseudo_batch_size = 1024 # 標記時的 batch 大小
 # print("loading data ...\n") # 把 'training_label.txt' 跟 'training_nolabel.txt' 讀進來
-train_x, y = load_training_data(train_with_label)
-# train_x_no_label = load_training_data(train_no_label)
+# 第一次讀取時轉成 uint32 的 token id 存在 cache_dir，之後直接 memory-map
+label_store = TokenStore(train_with_label, 'label', cache_dir)
+no_label_x = TokenStore(train_no_label, 'nolabel', cache_dir)
 
 # 對 input 跟 labels 做預處理
 print("preprocessing...\n")
-preprocess = Preprocess(train_x, sen_len, w2v_path=w2v_path)
+preprocess = Preprocess(label_store, sen_len, w2v_path=w2v_path)
 embedding = preprocess.make_embedding(load=True)
-train_x = preprocess.sentence_word2idx()
-y = preprocess.labels_to_tensor(y)
+preprocess.save_embedding(embedding_f, vocab_f)
+train_x = preprocess.sentence_word2idx(cache_dir, index_workers)
+lengths = preprocess.sequence_lengths(train_x) # 每句實際的長度，LSTM 只跑到這裡
+y = torch.from_numpy(label_store.labels.astype(np.int64))
 
 
 # 製作一個 model 的對象
@@ -51,23 +67,42 @@ model = model.to(device) # device為 "cuda"，model 使用 GPU 來訓練（餵
 
 # 把 data 分為 training data 跟 validation data（將一部份 training data 拿去當作 validation data）
 X_train, X_val, y_train, y_val = train_x[:180000], train_x[180000:], y[:180000], y[180000:]
+len_train, len_val = lengths[:180000], lengths[180000:]
 
 # 把 data 做成 dataset 供 dataloader 取用
-train_dataset = TwitterDataset(X=X_train, y=y_train)
-val_dataset = TwitterDataset(X=X_val, y=y_val)
+train_dataset = TwitterDataset(X=X_train, y=y_train, lengths=len_train)
+val_dataset = TwitterDataset(X=X_val, y=y_val, lengths=len_val)
 
-# 把 data 轉成 batch of tensors
+# 把 data 轉成 batch of tensors，長度相近的句子放在同一個 batch，每個 batch 只補到最長句子的長度
 train_loader = torch.utils.data.DataLoader(dataset = train_dataset,
-                                            batch_size = batch_size,
-                                            shuffle = True,
+                                            batch_sampler = BucketBatchSampler(len_train, batch_size, shuffle=True),
+                                            collate_fn = collate_batch,
                                             num_workers = 8)
 
 val_loader = torch.utils.data.DataLoader(dataset = val_dataset,
-                                            batch_size = batch_size,
-                                            shuffle = False,
+                                            batch_sampler = BucketBatchSampler(len_val, batch_size, shuffle=False),
+                                            collate_fn = collate_batch,
                                             num_workers = 8)
 
 # 開始訓練
 # print("training...\n")
-training(batch_size, epoch, lr, train_loader, val_loader, model, device, model_f)
+best_acc = training(batch_size, epoch, lr, train_loader, val_loader, model, device, model_f,
+                    log_steps=log_steps, log_interval=log_interval, metrics_f=metrics_f)
+
+# self-training
+for r in range(self_train_rounds):
+    print("\nself-training round {} ...".format(r + 1))
+    model = torch.load(model_f).to(device)
+    chunks = no_label_x.encoded_chunks(preprocess.word2idx, sen_len, preprocess.word2idx["<PAD>"],
+                                       preprocess.word2idx["<UNK>"], pseudo_chunk_size)
+    x_pseudo, len_pseudo, y_pseudo = pseudo_labeling(model, chunks, preprocess, threshold, pseudo_batch_size, device)
+    print("pseudo labels: {}".format(len(y_pseudo)))
+    pseudo_dataset = TwitterDataset(X=torch.cat((X_train, x_pseudo)), y=torch.cat((y_train, y_pseudo)),
+                                    lengths=torch.cat((len_train, len_pseudo)))
+    pseudo_loader = torch.utils.data.DataLoader(dataset = pseudo_dataset,
+                                                batch_sampler = BucketBatchSampler(pseudo_dataset.lengths, batch_size, shuffle=True),
+                                                collate_fn = collate_batch,
+                                                num_workers = 8)
+    best_acc = training(batch_size, self_train_epoch, lr, pseudo_loader, val_loader, model, device, model_f, best_acc,
+                        log_steps=log_steps, log_interval=log_interval, metrics_f=metrics_f)
 
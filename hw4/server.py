@@ -0,0 +1,155 @@
+"""
+sentiment scoring server,
+load the vocabulary, embedding and model once,
+accept raw tweets (one per line) over a local tcp socket,
+coalesce concurrent requests into micro-batches bounded by size and wait time,
+reply the probability of each tweet,
+send STATS to get throughput and latency histogram
+usage: python3 server.py [port]
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+from collections import deque
+import numpy as np
+import torch
+
+sys.path.append("./src")
+from preprocess import Preprocess
+from data import collate_batch
+sys.path.pop()
+from test import inference_mode
+
+w2v_path = './w2v_all.model'
+model_f = "./ckpt_final.model"
+quantized_model_f = "./ckpt_int8.pt"
+embedding_f = "./embedding.npy"
+vocab_f = "./embedding_vocab.txt"
+quantized = False # 是否用 export.py 存的 int8 TorchScript model (CPU)
+sen_len = 35
+port = 5004
+max_batch_size = 256 # 一個 micro-batch 最多幾句
+max_wait = 0.005 # 第一句進來後最多等幾秒湊 batch
+history = 100000 # 統計延遲時只保留最近幾句
+histogram_ms = [0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, float('inf')] # 延遲 histogram 的邊界 (ms)
+
+class Stats():
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.requests = 0
+        self.batches = 0
+        self.latencies = deque(maxlen=history) # ms
+    def add_batch(self, arrivals):
+        now = time.perf_counter()
+        self.requests += len(arrivals)
+        self.batches += 1
+        self.latencies.extend((now - t) * 1000 for t in arrivals)
+    def summary(self):
+        latencies = np.array(self.latencies) if self.latencies else np.zeros(1)
+        counts, _ = np.histogram(latencies, histogram_ms)
+        return {'requests': self.requests,
+                'avg_batch_size': self.requests / max(self.batches, 1),
+                'throughput': self.requests / (time.perf_counter() - self.start),
+                'p50_ms': float(np.percentile(latencies, 50)),
+                'p99_ms': float(np.percentile(latencies, 99)),
+                'latency_ms_histogram': {'{}-{}'.format(lo, hi): int(c)
+                                         for lo, hi, c in zip(histogram_ms[:-1], histogram_ms[1:], counts)}}
+
+def load_model():
+    # 字典跟 embedding 用 main.py 存的檔案，不用每次都讀 w2v model
+    preprocess = Preprocess([], sen_len, w2v_path=w2v_path)
+    if os.path.exists(embedding_f) and os.path.exists(vocab_f):
+        preprocess.load_embedding(embedding_f, vocab_f)
+    else:
+        preprocess.make_embedding(load=True)
+        preprocess.save_embedding(embedding_f, vocab_f)
+    if quantized:
+        device = torch.device("cpu")
+        model = torch.jit.load(quantized_model_f)
+    else:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        model = torch.load(model_f, map_location=device)
+    model.eval()
+    return preprocess, model, device
+
+def predict(preprocess, model, device, sentences):
+    # 跟 test.py 一樣轉成 index、只保留到最長句子的長度，回傳每句是負面的機率
+    preprocess.sentences = sentences
+    x = preprocess.sentence_word2idx()
+    inputs, lengths = collate_batch(list(zip(x, preprocess.sequence_lengths(x))))
+    with inference_mode():
+        return model(inputs.to(device, dtype=torch.long), lengths).view(-1).tolist()
+
+async def batching(queue, preprocess, model, device, stats):
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await queue.get()]
+        # 第一句進來後先等 max_wait 秒，這段時間其他連線的 tweet 也會進到 queue
+        await asyncio.sleep(max_wait)
+        while len(batch) < max_batch_size and not queue.empty():
+            batch.append(queue.get_nowait())
+        sentences, arrivals, futures = zip(*batch)
+        try:
+            probs = await loop.run_in_executor(None, predict, preprocess, model, device, list(sentences))
+        except Exception as e:
+            probs = [e] * len(futures)
+        for future, prob in zip(futures, probs):
+            if future.cancelled():
+                continue
+            if isinstance(prob, Exception):
+                future.set_exception(prob)
+            else:
+                future.set_result(prob)
+        stats.add_batch(arrivals)
+
+async def reply(text, previous, queue, stats, writer):
+    # 回覆要等同一個連線前一行的回覆寫出去之後才寫，順序才會跟送出的順序相同
+    if text == 'STATS':
+        line = json.dumps(stats.summary())
+    else:
+        future = asyncio.get_running_loop().create_future()
+        await queue.put((text.split(' '), time.perf_counter(), future))
+        try:
+            line = '{:.6f}'.format(await future)
+        except Exception as e:
+            line = 'ERROR {}'.format(e)
+    if previous is not None:
+        await previous
+    writer.write(line.encode('utf-8') + b'\n')
+
+async def handle(queue, stats, reader, writer):
+    # 每行一則 tweet (跟 training data 一樣以空白斷詞)，可以一次送很多行
+    last = None
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        text = line.decode('utf-8').strip()
+        if text:
+            last = asyncio.ensure_future(reply(text, last, queue, stats, writer))
+    if last is not None:
+        await last
+    await writer.drain()
+    writer.close()
+
+async def main(port):
+    stats = Stats()
+    queue = asyncio.Queue()
+    preprocess, model, device = load_model()
+    worker = asyncio.ensure_future(batching(queue, preprocess, model, device, stats))
+    server = await asyncio.start_server(lambda r, w: handle(queue, stats, r, w), '127.0.0.1', port)
+    print('serving on 127.0.0.1:{}'.format(port))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        worker.cancel()
+        print(json.dumps(stats.summary()))
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else port))
+    except KeyboardInterrupt:
+        pass
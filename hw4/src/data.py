@@ -8,12 +8,42 @@ class TwitterDataset(data.Dataset):
     input data shape : (data_num, seq_len, feature_dim)
     
     __len__ will return the number of data
+    lengths (optional) is the number of real tokens of each sentence,
+    if given, __getitem__ returns (data, length[, label])
     """
-    def __init__(self, X, y):
+    def __init__(self, X, y, lengths=None):
         self.data = X
         self.label = y
+        self.lengths = lengths
     def __getitem__(self, idx):
-        if self.label is None: return self.data[idx]
-        return self.data[idx], self.label[idx]
+        if self.lengths is None:
+            if self.label is None: return self.data[idx]
+            return self.data[idx], self.label[idx]
+        if self.label is None: return self.data[idx], self.lengths[idx]
+        return self.data[idx], self.lengths[idx], self.label[idx]
     def __len__(self):
-        return len(self.data)
\ No newline at end of file
+        return len(self.data)
+
+def collate_batch(batch):
+    # 給帶有 lengths 的 TwitterDataset 用：句子只保留到這個 batch 最長句子的長度，後面全是 <PAD>
+    batch = data.dataloader.default_collate(batch)
+    return (batch[0][:, :int(batch[1].max())],) + tuple(batch[1:])
+
+class BucketBatchSampler(data.Sampler):
+    # 長度相近的句子放進同一個 batch，搭配 collate_batch 每個 batch 只補到最長句子的長度
+    def __init__(self, lengths, batch_size, shuffle=True):
+        self.lengths = torch.as_tensor(lengths).float()
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+    def __iter__(self):
+        keys = self.lengths
+        if self.shuffle:
+            # 長度加上 [0, 1) 的亂數再排序，同樣長度的句子每個 epoch 分到不同的 batch
+            keys = keys + torch.rand(len(keys))
+        batches = torch.argsort(keys).split(self.batch_size)
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+        for batch in batches:
+            yield batch.tolist()
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
@@ -1,5 +1,11 @@
 import torch
 from torch import nn
+from torch.nn.utils.rnn import pack_padded_sequence
+
+def init_hidden(inputs, num_states, hidden_dim):
+    # 初始的 hidden state (全 0)，batch 大小取自 inputs.size(0)
+    # 不交給 RNN 自己用 batch_sizes[0] 產生，trace 成 TorchScript 之後 batch 大小才不會被固定住
+    return inputs.new_zeros(num_states, inputs.size(0), hidden_dim)
 
 class LSTM_Net(nn.Module):
     def __init__(self, embedding, embedding_dim, hidden_dim, num_layers, dropout=0.5, fix_embedding=True):
@@ -17,12 +23,19 @@ class LSTM_Net(nn.Module):
         self.classifier = nn.Sequential( nn.Dropout(dropout),
                                          nn.Linear(hidden_dim, 1),
                                          nn.Sigmoid() )
-    def forward(self, inputs):
+    def forward(self, inputs, lengths=None):
         inputs = self.embedding(inputs)
-        x, _ = self.lstm(inputs, None)
-        # x 的 dimension (batch, seq_len, hidden_size) 
-        # 取用 LSTM 最後一層的 hidden state
-        x = x[:, -1, :] 
+        if lengths is None:
+            x, _ = self.lstm(inputs, None)
+            # x 的 dimension (batch, seq_len, hidden_size) 
+            # 取用 LSTM 最後一層的 hidden state
+            x = x[:, -1, :] 
+        else:
+            # 只跑每句實際的長度，取最後一層在最後一個真正的字的 hidden state
+            packed = pack_padded_sequence(inputs, lengths.cpu(), batch_first=True, enforce_sorted=False)
+            h0 = init_hidden(inputs, self.num_layers, self.hidden_dim)
+            _, (h, _) = self.lstm(packed, (h0, h0))
+            x = h[-1]
         x = self.classifier(x)
         return x
 
@@ -42,11 +55,74 @@ class bi_LSTM_Net(nn.Module):
         self.classifier = nn.Sequential( nn.Dropout(dropout),
                                          nn.Linear(hidden_dim*2, 1),
                                          nn.Sigmoid() )
-    def forward(self, inputs):
+    def forward(self, inputs, lengths=None):
+        inputs = self.embedding(inputs)
+        if lengths is None:
+            x, _ = self.lstm(inputs, None)
+            # x 的 dimension (batch, seq_len, hidden_size) 
+            # 取用 LSTM 最後一層的 hidden state
+            x = x[:, -1, :] 
+        else:
+            # 只跑每句實際的長度，正向取最後一個真正的字的 hidden state，反向取第一個字的 hidden state
+            packed = pack_padded_sequence(inputs, lengths.cpu(), batch_first=True, enforce_sorted=False)
+            h0 = init_hidden(inputs, self.num_layers * 2, self.hidden_dim)
+            _, (h, _) = self.lstm(packed, (h0, h0))
+            x = torch.cat((h[-2], h[-1]), 1)
+        x = self.classifier(x)
+        return x
+
+class GRU_Net(nn.Module):
+    # 跟 bi_LSTM_Net 一樣，RNN 換成雙向 GRU
+    def __init__(self, embedding, embedding_dim, hidden_dim, num_layers, dropout=0.5, fix_embedding=True):
+        super(GRU_Net, self).__init__()
+        self.embedding = torch.nn.Embedding(embedding.size(0),embedding.size(1))
+        self.embedding.weight = torch.nn.Parameter(embedding)
+        self.embedding.weight.requires_grad = False if fix_embedding else True
+        self.embedding_dim = embedding.size(1)
+        self.hidden_dim = hidden_dim
+        self.num_layers = num_layers
+        self.dropout = dropout
+        self.gru = nn.GRU(embedding_dim, hidden_dim, num_layers=num_layers, batch_first=True, bidirectional=True)
+        self.classifier = nn.Sequential( nn.Dropout(dropout),
+                                         nn.Linear(hidden_dim*2, 1),
+                                         nn.Sigmoid() )
+    def forward(self, inputs, lengths=None):
         inputs = self.embedding(inputs)
-        x, _ = self.lstm(inputs, None)
-        # x 的 dimension (batch, seq_len, hidden_size) 
-        # 取用 LSTM 最後一層的 hidden state
-        x = x[:, -1, :] 
+        if lengths is None:
+            x, _ = self.gru(inputs, None)
+            x = x[:, -1, :]
+        else:
+            packed = pack_padded_sequence(inputs, lengths.cpu(), batch_first=True, enforce_sorted=False)
+            _, h = self.gru(packed, init_hidden(inputs, self.num_layers * 2, self.hidden_dim))
+            x = torch.cat((h[-2], h[-1]), 1)
         x = self.classifier(x)
+        return x
+
+class CNN_Net(nn.Module):
+    # 不用 RNN：不同寬度的 1D convolution，再對整句取 max (不含 <PAD> 的位置)
+    # hidden_dim 為每種寬度的 channel 數，num_layers 為 convolution 的種類數 (寬度 3, 4, 5, ...)
+    def __init__(self, embedding, embedding_dim, hidden_dim, num_layers, dropout=0.5, fix_embedding=True):
+        super(CNN_Net, self).__init__()
+        self.embedding = torch.nn.Embedding(embedding.size(0),embedding.size(1))
+        self.embedding.weight = torch.nn.Parameter(embedding)
+        self.embedding.weight.requires_grad = False if fix_embedding else True
+        self.embedding_dim = embedding.size(1)
+        self.hidden_dim = hidden_dim
+        self.num_layers = num_layers
+        self.dropout = dropout
+        self.convs = nn.ModuleList([nn.Conv1d(embedding_dim, hidden_dim, k, padding=k // 2) for k in range(3, 3 + num_layers)])
+        self.classifier = nn.Sequential( nn.Dropout(dropout),
+                                         nn.Linear(hidden_dim*num_layers, 1),
+                                         nn.Sigmoid() )
+    def forward(self, inputs, lengths=None):
+        seq_len = inputs.size(1)
+        x = self.embedding(inputs).transpose(1, 2) # (batch, embedding_dim, seq_len)
+        outputs = []
+        for conv in self.convs:
+            out = torch.relu(conv(x))[:, :, :seq_len]
+            if lengths is not None:
+                mask = torch.arange(seq_len, device=out.device)[None, :] >= lengths.to(out.device)[:, None]
+                out = out.masked_fill(mask.unsqueeze(1), float('-inf'))
+            outputs.append(out.max(2)[0])
+        x = self.classifier(torch.cat(outputs, 1))
         return x
\ No newline at end of file
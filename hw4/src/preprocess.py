@@ -1,9 +1,32 @@
 """
 preprocess data
 """
+import os
+import hashlib
+import numpy as np
 import torch
 from torch import nn
-from gensim.models import Word2Vec
+from multiprocessing import Pool
+
+def encode_sentences(sentences, word2idx, sen_len, pad, unk, out=None):
+    # 把一批句子轉成 index 寫進填滿 <PAD> 的 int32 陣列，超過 sen_len 的字直接截掉
+    if out is None:
+        out = np.full((len(sentences), sen_len), pad, dtype=np.int32)
+    get = word2idx.get
+    for i, sen in enumerate(sentences):
+        idx = [get(word, unk) for word in sen[:sen_len]]
+        out[i, :len(idx)] = idx
+    return out
+
+_worker_args = None
+
+def _init_worker(word2idx, sen_len, pad, unk):
+    # 每個 worker 只在啟動時收一次字典
+    global _worker_args
+    _worker_args = (word2idx, sen_len, pad, unk)
+
+def _encode_worker(sentences):
+    return encode_sentences(sentences, *_worker_args)
 
 class Preprocess():
     def __init__(self, sentences, sen_len, w2v_path="./w2v.model"):
@@ -13,18 +36,16 @@ class Preprocess():
         self.idx2word = []
         self.word2idx = {}
         self.embedding_matrix = []
+        self.vocab_id = w2v_path # 字典的來源，index cache 的 key 之一
     def get_w2v_model(self):
         # 把之前訓練好的 word to vec 模型讀進來
+        from gensim.models import Word2Vec # 只有從 w2v model 建 embedding 時才需要 gensim
         self.embedding = Word2Vec.load(self.w2v_path)
         self.embedding_dim = self.embedding.vector_size
-    def add_embedding(self, word):
-        # 把 word 加進 embedding，並賦予他一個隨機生成的 representation vector
-        # word 只會是 "<PAD>" 或 "<UNK>"
-        vector = torch.empty(1, self.embedding_dim)
-        torch.nn.init.uniform_(vector)
-        self.word2idx[word] = len(self.word2idx)
-        self.idx2word.append(word)
-        self.embedding_matrix = torch.cat([self.embedding_matrix, vector], 0)
+        self.vocab_id = self.file_id(self.w2v_path)
+    def file_id(self, path):
+        # 檔案的路徑、大小、修改時間，檔案換過 cache 就會失效
+        return '{}:{}:{}'.format(os.path.abspath(path), os.path.getsize(path), os.path.getmtime(path))
     def make_embedding(self, load=True):
         print("Get embedding ...")
         # 取得訓練好的 Word2vec word embedding
@@ -35,20 +56,34 @@ class Preprocess():
             raise NotImplementedError
         # 製作一個 word2idx 的 dictionary
         # 製作一個 idx2word 的 list
-        # 製作一個 word2vector 的 list
-        for i, word in enumerate(self.embedding.wv.vocab):
-            print('get words #{}'.format(i+1), end='\r')
-            #e.g. self.word2index['he'] = 1 
-            #e.g. self.index2word[1] = 'he'
-            #e.g. self.vectors[1] = 'he' vector
-            self.word2idx[word] = len(self.word2idx)
-            self.idx2word.append(word)
-            self.embedding_matrix.append(self.embedding[word])
-        print('')
-        self.embedding_matrix = torch.tensor(self.embedding_matrix)
-        # 將 "<PAD>" 跟 "<UNK>" 加進 embedding 裡面
-        self.add_embedding("<PAD>")
-        self.add_embedding("<UNK>")
+        # 依照 wv.vocab 的順序編號 (跟已經訓練好的模型相同)，一次從 wv.vectors 取出所有向量
+        #e.g. self.word2index['he'] = 1 
+        #e.g. self.index2word[1] = 'he'
+        #e.g. self.vectors[1] = 'he' vector
+        wv = self.embedding.wv
+        self.idx2word = list(wv.vocab) + ["<PAD>", "<UNK>"]
+        self.word2idx = {word: i for i, word in enumerate(self.idx2word)}
+        rows = np.fromiter((wv.vocab[word].index for word in self.idx2word[:-2]), dtype=np.int64, count=len(self.idx2word) - 2)
+        self.embedding_matrix = torch.empty(len(self.idx2word), self.embedding_dim)
+        self.embedding_matrix[:-2] = torch.from_numpy(wv.vectors[rows])
+        # "<PAD>" 跟 "<UNK>" 賦予隨機生成的 representation vector
+        torch.nn.init.uniform_(self.embedding_matrix[-2:])
+        print("total words: {}".format(len(self.embedding_matrix)))
+        return self.embedding_matrix
+    def save_embedding(self, embedding_f, vocab_f):
+        # embedding 存成 .npy，字典一行一個字 (行號即 index)
+        np.save(embedding_f, self.embedding_matrix.numpy())
+        with open(vocab_f, 'w', encoding='utf-8', newline='\n') as f:
+            for word in self.idx2word:
+                f.write(word + '\n')
+    def load_embedding(self, embedding_f, vocab_f):
+        # 讀取 save_embedding 存的字典跟 embedding，embedding 是 memory-mapped (copy-on-write)，不需要載入 gensim 的 model
+        with open(vocab_f, 'r', encoding='utf-8', newline='\n') as f:
+            self.idx2word = f.read().split('\n')[:-1]
+        self.word2idx = {word: i for i, word in enumerate(self.idx2word)}
+        self.embedding_matrix = torch.from_numpy(np.load(embedding_f, mmap_mode='c'))
+        self.embedding_dim = self.embedding_matrix.size(1)
+        self.vocab_id = self.file_id(vocab_f)
         print("total words: {}".format(len(self.embedding_matrix)))
         return self.embedding_matrix
     def pad_sequence(self, sentence):
@@ -61,21 +96,49 @@ class Preprocess():
                 sentence.append(self.word2idx["<PAD>"])
         assert len(sentence) == self.sen_len
         return sentence
-    def sentence_word2idx(self):
-        # 把句子裡面的字轉成相對應的 index
-        sentence_list = []
-        for i, sen in enumerate(self.sentences):
-            print('sentence count #{}'.format(i+1), end='\r')
-            sentence_idx = []
-            for word in sen:
-                if (word in self.word2idx.keys()):
-                    sentence_idx.append(self.word2idx[word])
-                else:
-                    sentence_idx.append(self.word2idx["<UNK>"])
-            # 將每個句子變成一樣的長度
-            sentence_idx = self.pad_sequence(sentence_idx)
-            sentence_list.append(sentence_idx)
-        return torch.LongTensor(sentence_list)
+    def corpus_key(self):
+        # index cache 的 key：句子內容、字典來源跟 sen_len 的 hash
+        h = hashlib.sha1()
+        h.update('{}|{}'.format(self.vocab_id, self.sen_len).encode('utf-8'))
+        if hasattr(self.sentences, 'key'):
+            # TokenStore 直接用檔案的識別，不用讀出每一句
+            h.update(self.sentences.key().encode('utf-8'))
+            return h.hexdigest()[:16]
+        for sen in self.sentences:
+            h.update(' '.join(sen).encode('utf-8'))
+            h.update(b'\n')
+        return h.hexdigest()[:16]
+    def sentence_word2idx(self, cache_dir=None, workers=1, chunk_size=20000):
+        # 把句子裡面的字轉成相對應的 index，回傳 [N, sen_len] 的 int32 tensor
+        # 句子分成 chunk_size 句一組，workers > 1 時交給多個 process 平行處理
+        # 有 cache_dir 時結果存成 .npy，同樣的句子跟字典下次直接讀取
+        # sentences 是 TokenStore 時直接用陣列運算轉換
+        if cache_dir is not None:
+            cache_f = os.path.join(cache_dir, 'idx_{}.npy'.format(self.corpus_key()))
+            if os.path.exists(cache_f):
+                return torch.from_numpy(np.load(cache_f))
+        pad, unk = self.word2idx["<PAD>"], self.word2idx["<UNK>"]
+        ret = np.full((len(self.sentences), self.sen_len), pad, dtype=np.int32)
+        starts = range(0, len(self.sentences), chunk_size)
+        if hasattr(self.sentences, 'encode'):
+            for i in starts:
+                ret[i:i + chunk_size] = self.sentences.encode(self.word2idx, self.sen_len, pad, unk, i, i + chunk_size)
+        elif workers > 1:
+            with Pool(workers, _init_worker, (self.word2idx, self.sen_len, pad, unk)) as pool:
+                chunks = (self.sentences[i:i + chunk_size] for i in starts)
+                for i, part in zip(starts, pool.imap(_encode_worker, chunks)):
+                    ret[i:i + len(part)] = part
+        else:
+            for i in starts:
+                encode_sentences(self.sentences[i:i + chunk_size], self.word2idx, self.sen_len, pad, unk,
+                                 out=ret[i:i + chunk_size])
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            np.save(cache_f, ret)
+        return torch.from_numpy(ret)
+    def sequence_lengths(self, x):
+        # 每句實際的長度 (<PAD> 只會補在句尾)，空句子當成長度 1
+        return (x != self.word2idx["<PAD>"]).sum(1).clamp(min=1)
     def labels_to_tensor(self, y):
         # 把 labels 轉成 tensor
         y = [int(label) for label in y]
@@ -0,0 +1,114 @@
+"""
+memory-mapped token store of a tokenized corpus,
+stream the text file once and write a flat uint32 token-id array plus offsets,
+later runs memory-map the arrays instead of building lists of python strings
+"""
+import os
+import hashlib
+import numpy as np
+
+def parse_line(line, kind):
+    # 跟 utils.load_training_data / load_testing_data 相同的斷詞方式，回傳 (tokens, label)
+    if kind == 'label':
+        line = line.strip('\n').split(' ')
+        return line[2:], int(line[0])
+    if kind == 'nolabel':
+        return line.strip('\n').split(' '), None
+    return "".join(line.strip('\n').split(",")[1:]).strip().split(' '), None
+
+class TokenStore(object):
+    """
+    kind: 'label' (training_label.txt), 'nolabel' (training_nolabel.txt) or 'test' (testing_data.txt)
+    tokens: flat uint32 ids into self.words, sentence i is tokens[offsets[i]:offsets[i + 1]]
+    labels: uint8 labels of 'label' stores, otherwise None
+    """
+    def __init__(self, path, kind, cache_dir='./cache', flush_tokens=1 << 20):
+        self.path = path
+        self.kind = kind
+        # cache 的檔名帶有原始檔案的路徑、大小、修改時間的 hash，換了檔案或檔案改過都會用不同的 cache
+        source = '{}:{}:{}:{}'.format(os.path.abspath(path), os.path.getsize(path), os.path.getmtime(path), kind)
+        prefix = os.path.join(cache_dir, '{}_{}'.format(os.path.splitext(os.path.basename(path))[0],
+                                                        hashlib.sha1(source.encode('utf-8')).hexdigest()[:16]))
+        self.tokens_f = prefix + '_tokens.u32'
+        self.offsets_f = prefix + '_offsets.npy'
+        self.labels_f = prefix + '_labels.npy'
+        self.words_f = prefix + '_words.txt'
+        files = [self.tokens_f, self.offsets_f, self.words_f] + ([self.labels_f] if kind == 'label' else [])
+        if not all(os.path.exists(f) for f in files):
+            os.makedirs(cache_dir, exist_ok=True)
+            self.build(flush_tokens)
+        self.load()
+
+    def build(self, flush_tokens):
+        # 一行一行讀，token 每累積 flush_tokens 個就寫進檔案，記憶體裡只有字典跟 offsets
+        word2id, words = {}, []
+        offsets, labels = [0], []
+        buffer = []
+        with open(self.path, 'r') as f, open(self.tokens_f, 'wb') as out:
+            if self.kind == 'test':
+                next(f, None) # 跳過 header
+            for line in f:
+                tokens, label = parse_line(line, self.kind)
+                for word in tokens:
+                    idx = word2id.get(word)
+                    if idx is None:
+                        idx = word2id[word] = len(words)
+                        words.append(word)
+                    buffer.append(idx)
+                offsets.append(offsets[-1] + len(tokens))
+                if label is not None:
+                    labels.append(label)
+                if len(buffer) >= flush_tokens:
+                    out.write(np.array(buffer, dtype=np.uint32).tobytes())
+                    buffer = []
+            out.write(np.array(buffer, dtype=np.uint32).tobytes())
+        np.save(self.offsets_f, np.array(offsets, dtype=np.int64))
+        if self.kind == 'label':
+            np.save(self.labels_f, np.array(labels, dtype=np.uint8))
+        with open(self.words_f, 'w', encoding='utf-8', newline='\n') as f:
+            for word in words:
+                f.write(word + '\n')
+
+    def load(self):
+        size = os.path.getsize(self.tokens_f)
+        self.tokens = np.memmap(self.tokens_f, dtype=np.uint32, mode='r') if size else np.zeros(0, dtype=np.uint32)
+        self.offsets = np.load(self.offsets_f)
+        self.labels = np.load(self.labels_f) if self.kind == 'label' else None
+        with open(self.words_f, 'r', encoding='utf-8', newline='\n') as f:
+            self.words = f.read().split('\n')[:-1]
+
+    def key(self):
+        # 內容的識別 (token 檔的路徑、大小、修改時間)，給 index cache 用
+        return '{}:{}:{}'.format(os.path.abspath(self.tokens_f), os.path.getsize(self.tokens_f), os.path.getmtime(self.tokens_f))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        # 第 idx 句的字 (list of str)
+        return [self.words[t] for t in self.tokens[self.offsets[idx]:self.offsets[idx + 1]].tolist()]
+
+    def __iter__(self):
+        # 每次 iterate 都從頭開始，可以重複使用 (e.g. word2vec 的多個 epoch)
+        for i in range(len(self)):
+            yield self[i]
+
+    def encode(self, word2idx, sen_len, pad, unk, start=0, end=None):
+        # 把第 start 到 end 句轉成 word2idx 的 index，回傳補滿 <PAD> 的 [N, sen_len] int32 陣列
+        # 字典對應只對 store 裡不重複的字做一次，之後全部是陣列運算
+        if not hasattr(self, 'remap') or self.remap[0] is not word2idx:
+            self.remap = (word2idx, np.array([word2idx.get(word, unk) for word in self.words], dtype=np.int32))
+        remap = self.remap[1]
+        end = len(self) if end is None else min(end, len(self))
+        begin = self.offsets[start:end]
+        lengths = np.minimum(self.offsets[start + 1:end + 1] - begin, sen_len)
+        cols = np.arange(sen_len)
+        mask = cols[None, :] < lengths[:, None]
+        out = np.full((end - start, sen_len), pad, dtype=np.int32)
+        out[mask] = remap[self.tokens[(begin[:, None] + cols[None, :])[mask]]]
+        return out
+
+    def encoded_chunks(self, word2idx, sen_len, pad, unk, chunk_size=100000):
+        # 一次產生 chunk_size 句轉好 index 的陣列，記憶體只跟 chunk 大小有關
+        for start in range(0, len(self), chunk_size):
+            yield self.encode(word2idx, sen_len, pad, unk, start, start + chunk_size)
@@ -1,3 +1,5 @@
+import json
+import time
 import torch
 from torch import nn
 import torch.optim as optim
@@ -6,7 +8,11 @@ import numpy as np
 
 from utils import evaluation
 
-def training(batch_size, n_epoch, lr, train, valid, model, device, model_f):
+def training(batch_size, n_epoch, lr, train, valid, model, device, model_f, best_acc=0,
+             log_steps=50, log_interval=1.0, metrics_f=None):
+    # best_acc: 之前存下來的模型的 validation accuracy，只有超過它才會覆蓋 model_f，回傳最後的 best_acc
+    # loss 跟答對的數量累加在 device 上，每 log_steps 個 batch 才同步一次，而且距離上次 print 超過 log_interval 秒才 print
+    # metrics_f: 每次同步的結果跟每個 epoch 的 train / valid 結果以一行一個 json 的格式附加到這個檔案
     # t_loss = []
     # t_acc = []
     # v_loss = []
@@ -18,59 +24,105 @@ def training(batch_size, n_epoch, lr, train, valid, model, device, model_f):
     model.train() # 將 model 的模式設為 train，這樣 optimizer 就可以更新 model 的參數
     criterion = nn.BCELoss() # 定義損失函數，這裡我們使用 binary cross entropy loss
     t_batch = len(train) 
-    v_batch = len(valid) 
     optimizer = optim.Adam(model.parameters(), lr=lr) # 將模型的參數給 optimizer，並給予適當的 learning rate
-    total_loss, total_acc, best_acc = 0, 0, 0
+    metrics = open(metrics_f, 'a') if metrics_f is not None else None
+    def write_metrics(**record):
+        if metrics is not None:
+            metrics.write(json.dumps(record) + '\n')
+            metrics.flush()
     for epoch in range(n_epoch):
-        total_loss, total_acc = 0, 0
         # 這段做 training
-        for i, (inputs, labels) in enumerate(train):
+        start = last_print = time.time()
+        total_loss = torch.zeros((), device=device)
+        total_acc = torch.zeros((), dtype=torch.long, device=device)
+        n = 0
+        for i, (inputs, lengths, labels) in enumerate(train):
             inputs = inputs.to(device, dtype=torch.long) # device 為 "cuda"，將 inputs 轉成 torch.cuda.LongTensor
             labels = labels.to(device, dtype=torch.float) # device為 "cuda"，將 labels 轉成 torch.cuda.FloatTensor，因為等等要餵進 criterion，所以型態要是 float
             optimizer.zero_grad() # 由於 loss.backward() 的 gradient 會累加，所以每次餵完一個 batch 後需要歸零
-            outputs = model(inputs) # 將 input 餵給模型
-            outputs = outputs.squeeze() # 去掉最外面的 dimension，好讓 outputs 可以餵進 criterion()
+            outputs = model(inputs, lengths) # 將 input 跟每句的長度餵給模型 (lengths 留在 cpu 上給 pack_padded_sequence 用)
+            outputs = outputs.view(-1) # 去掉最外面的 dimension，好讓 outputs 可以餵進 criterion()
             loss = criterion(outputs, labels) # 計算此時模型的 training loss
             loss.backward() # 算 loss 的 gradient
             optimizer.step() # 更新訓練模型的參數
-            correct = evaluation(outputs, labels) # 計算此時模型的 training accuracy
-            total_acc += (correct / batch_size)
-            total_loss += loss.item()
-            print('[ Epoch{}: {}/{} ] loss:{:.3f} acc:{:.3f} '.format(
-            	epoch+1, i+1, t_batch, loss.item(), correct/batch_size), end='\r')
-        print('\nTrain | Loss:{:.5f} Acc: {:.3f}'.format(total_loss/t_batch, total_acc/t_batch))
-        # t_loss.append(total_loss/t_batch)
-        # t_acc.append(total_acc/t_batch)
+            # 累加這個 batch 的 loss 跟答對的數量 (不 .item()，最後一個 batch 比較小也照實際的句數計算)
+            total_loss += loss.detach() * len(labels)
+            total_acc += evaluation(outputs.detach(), labels)
+            n += len(labels)
+            if (i + 1) % log_steps == 0 or i + 1 == t_batch:
+                loss_avg, acc = total_loss.item() / n, total_acc.item() / n
+                write_metrics(phase='train', epoch=epoch + 1, step=i + 1, loss=loss_avg, acc=acc, time=time.time() - start)
+                if time.time() - last_print >= log_interval:
+                    last_print = time.time()
+                    print('[ Epoch{}: {}/{} ] loss:{:.3f} acc:{:.3f} '.format(
+                        epoch+1, i+1, t_batch, loss_avg, acc), end='\r')
+        train_loss, train_acc = total_loss.item() / max(n, 1), total_acc.item() / max(n, 1)
+        print('\nTrain | Loss:{:.5f} Acc: {:.3f}'.format(train_loss, train_acc))
+        write_metrics(phase='train_epoch', epoch=epoch + 1, loss=train_loss, acc=train_acc, time=time.time() - start)
+        # t_loss.append(train_loss)
+        # t_acc.append(train_acc)
 
         # 這段做 validation
         model.eval() # 將 model 的模式設為 eval，這樣 model 的參數就會固定住
         with torch.no_grad():
-            total_loss, total_acc = 0, 0
-            for i, (inputs, labels) in enumerate(valid):
+            start = time.time()
+            total_loss = torch.zeros((), device=device)
+            total_acc = torch.zeros((), dtype=torch.long, device=device)
+            n = 0
+            for i, (inputs, lengths, labels) in enumerate(valid):
                 inputs = inputs.to(device, dtype=torch.long) # device 為 "cuda"，將 inputs 轉成 torch.cuda.LongTensor
                 labels = labels.to(device, dtype=torch.float) # device 為 "cuda"，將 labels 轉成 torch.cuda.FloatTensor，因為等等要餵進 criterion，所以型態要是 float
-                outputs = model(inputs) # 將 input 餵給模型
-                outputs = outputs.squeeze() # 去掉最外面的 dimension，好讓 outputs 可以餵進 criterion()
+                outputs = model(inputs, lengths) # 將 input 跟每句的長度餵給模型
+                outputs = outputs.view(-1) # 去掉最外面的 dimension，好讓 outputs 可以餵進 criterion()
                 loss = criterion(outputs, labels) # 計算此時模型的 validation loss
-                correct = evaluation(outputs, labels) # 計算此時模型的 validation accuracy
-                total_acc += (correct / batch_size)
-                total_loss += loss.item()
+                total_loss += loss * len(labels)
+                total_acc += evaluation(outputs, labels) # 計算此時模型的 validation accuracy
+                n += len(labels)
+            valid_loss, valid_acc = total_loss.item() / max(n, 1), total_acc.item() / max(n, 1)
 
-            print("Valid | Loss:{:.5f} Acc: {:.3f} ".format(total_loss/v_batch, total_acc/v_batch))
-            if total_acc > best_acc:
+            print("Valid | Loss:{:.5f} Acc: {:.3f} ".format(valid_loss, valid_acc))
+            write_metrics(phase='valid', epoch=epoch + 1, loss=valid_loss, acc=valid_acc, time=time.time() - start)
+            if valid_acc > best_acc:
                 # 如果 validation 的結果優於之前所有的結果，就把當下的模型存下來以備之後做預測時使用
-                best_acc = total_acc
+                best_acc = valid_acc
                 torch.save(model, model_f)
-                print('saving model with acc {:.3f}'.format(total_acc/v_batch))
-        # v_loss.append(total_loss/v_batch)
-        # v_acc.append(total_acc/v_batch)
+                print('saving model with acc {:.3f}'.format(valid_acc))
+        # v_loss.append(valid_loss)
+        # v_acc.append(valid_acc)
         model.train() # 將 model 的模式設為 train，這樣 optimizer 就可以更新 model 的參數（因為剛剛轉成 eval 模式)
 
+    if metrics is not None:
+        metrics.close()
 
     # np.save("./plot/train_loss_{}2.npy".format(msg), t_loss)
     # np.save("./plot/train_acc_{}2.npy".format(msg), t_acc)
     # np.save("./plot/val_loss_{}2.npy".format(msg), v_loss)
     # np.save("./plot/val_acc_{}2.npy".format(msg), v_acc)
-    
-
+    return best_acc
 
+def pseudo_labeling(model, chunks, preprocess, threshold, batch_size, device):
+    # self-training：用目前的模型預測沒有 label 的句子，只保留機率 <= threshold 或 >= 1 - threshold 的句子當作新的 training data
+    # chunks 每次產生一批轉好 index 的 [N, sen_len] int32 陣列 (TokenStore.encoded_chunks)，記憶體只跟 chunk 的大小有關
+    # 保留的句子存成 int32 的 index，回傳 (x, lengths, y)
+    model.eval()
+    xs, lens, ys = [], [], []
+    with torch.no_grad():
+        for x in chunks:
+            x = torch.from_numpy(x)
+            lengths = preprocess.sequence_lengths(x)
+            # 依長度排序後再切 batch，每個 batch 只補到最長句子的長度
+            order = torch.argsort(lengths)
+            probs = torch.empty(len(x))
+            for i in range(0, len(x), batch_size):
+                idx = order[i:i + batch_size]
+                batch_len = lengths[idx]
+                inputs = x[idx, :int(batch_len.max())].to(device, dtype=torch.long)
+                probs[idx] = model(inputs, batch_len).view(-1).cpu()
+            keep = (probs <= threshold) | (probs >= 1 - threshold)
+            xs.append(x[keep])
+            lens.append(lengths[keep])
+            ys.append((probs[keep] >= 0.5).long())
+    model.train()
+    if not xs:
+        return torch.zeros(0, preprocess.sen_len, dtype=torch.int32), torch.zeros(0, dtype=torch.long), torch.zeros(0, dtype=torch.long)
+    return torch.cat(xs), torch.cat(lens), torch.cat(ys)
@@ -36,8 +36,8 @@ def load_testing_data(path='testing_data.txt'):
 def evaluation(outputs, labels):
     # outputs => probability (float)
     # labels => labels
-    outputs[outputs>=0.5] = 1 # 大於等於 0.5 為有惡意
-    outputs[outputs<0.5] = 0 # 小於 0.5 為無惡意
-    correct = torch.sum(torch.eq(outputs, labels)).item()
+    # 不修改 outputs，回傳答對數量的 tensor (留在 device 上，需要時再 .item())
+    preds = (outputs >= 0.5).to(labels.dtype) # 大於等於 0.5 為有惡意，小於 0.5 為無惡意
+    correct = torch.sum(torch.eq(preds, labels))
     return correct
 
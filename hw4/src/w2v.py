@@ -2,32 +2,69 @@
 train word embedding
 """
 import os
+import time
 import numpy as np
 import pandas as pd
 import argparse
 from gensim.models import word2vec
 
 from utils import load_training_data, load_testing_data
+from token_store import TokenStore
 
-def train_word2vec(x, size, window):
+class Corpus(object):
+    # 依序讀出多個 TokenStore 的句子，不需要把整個語料放進記憶體
+    # 每次 iterate 都從頭開始，word2vec 建字典跟每個 epoch 都會重新 iterate 一次
+    def __init__(self, stores):
+        self.stores = stores
+    def __iter__(self):
+        for store in self.stores:
+            for sentence in store:
+                yield sentence
+    def __len__(self):
+        return sum(len(store) for store in self.stores)
+
+def train_word2vec(x, size=250, window=5, min_count=5, workers=12, iter=10, sg=1):
     # 訓練 word to vector 的 word embedding
     # size: dim of word, iter: iteration, sg: 0 (CBOW), 1 (Skip-gram), windows: # of words taken to predict the word, min_count:  Ignores all words with total frequency lower than this 
-    model = word2vec.Word2Vec(x, size=size, window=window, min_count=5, workers=12, iter=10, sg=1) # size=250, window=5, min_count=5, workers=12, iter=10, sg=1
+    # 分開建字典跟訓練，印出各自的時間跟每秒處理的字數
+    model = word2vec.Word2Vec(size=size, window=window, min_count=min_count, workers=workers, iter=iter, sg=sg)
+    start = time.time()
+    model.build_vocab(x)
+    vocab_time = time.time() - start
+    start = time.time()
+    trained, raw = model.train(x, total_examples=model.corpus_count, epochs=model.epochs)
+    train_time = time.time() - start
+    print("build vocab: {:.1f} sec, {} sentences, {} words in vocab".format(vocab_time, model.corpus_count, len(model.wv.vocab)))
+    print("train: {:.1f} sec, {:.0f} words/sec ({} effective words, {} raw words, {} workers)".format(
+        train_time, raw / max(train_time, 1e-9), trained, raw, workers))
     return model
 
 if __name__ == "__main__":
-    
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--train_label', default='./data/training_label.txt')
+    parser.add_argument('--train_nolabel', default='./data/training_nolabel.txt')
+    parser.add_argument('--test', default='./data/testing_data.txt')
+    parser.add_argument('--output', default='./w2v_all.model')
+    parser.add_argument('--cache_dir', default='./cache') # token store 存放的位置
+    parser.add_argument('--size', type=int, default=250)
+    parser.add_argument('--window', type=int, default=5)
+    parser.add_argument('--min_count', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--iter', type=int, default=10)
+    parser.add_argument('--sg', type=int, default=1)
+    args = parser.parse_args()
+
     print("loading training data ...")
-    train_x, y = load_training_data('./data/training_label.txt')
-    train_x_no_label = load_training_data('./data/training_nolabel.txt')
+    stores = [TokenStore(args.train_label, 'label', args.cache_dir)]
+    if args.train_nolabel:
+        stores.append(TokenStore(args.train_nolabel, 'nolabel', args.cache_dir))
 
-    print("loading testing data ...")
-    test_x = load_testing_data('./data/testing_data.txt')
+    if args.test:
+        print("loading testing data ...")
+        stores.append(TokenStore(args.test, 'test', args.cache_dir))
 
-    model = train_word2vec((train_x + train_x_no_label + test_x), 5, 250)
-    # model = train_word2vec(train_x + test_x)
+    model = train_word2vec(Corpus(stores), size=args.size, window=args.window, min_count=args.min_count,
+                           workers=args.workers, iter=args.iter, sg=args.sg)
     
     print("saving model ...")
-    model_f = './w2v_all.model'
-    model.save(model_f)
-
+    model.save(args.output)
@@ -1,3 +1,4 @@
+import os
 import sys
 import torch
 from torch import nn
@@ -7,19 +8,23 @@ import pandas as pd
 
 sys.path.append("./src")
 from utils import load_testing_data
+from token_store import TokenStore
 from preprocess import Preprocess
 from model import bi_LSTM_Net
-from data import TwitterDataset
+from data import TwitterDataset, collate_batch
 sys.path.pop()
 
+# 舊版 torch 沒有 inference_mode 時用 no_grad
+inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+
 def testing(batch_size, test_loader, model, device):
     model.eval()
     ret_output = []
-    with torch.no_grad():
-        for i, inputs in enumerate(test_loader):
+    with inference_mode():
+        for i, (inputs, lengths) in enumerate(test_loader):
             inputs = inputs.to(device, dtype=torch.long)
-            outputs = model(inputs)
-            outputs = outputs.squeeze()
+            outputs = model(inputs, lengths)
+            outputs = outputs.view(-1)
             outputs[outputs>=0.5] = 1 # 大於等於 0.5 為負面
             outputs[outputs<0.5] = 0 # 小於 0.5 為正面
             ret_output += outputs.int().tolist()
@@ -30,6 +35,12 @@ if __name__ == "__main__":
     
     w2v_path = './w2v_all.model'
     model_f = "./ckpt_final.model"
+    quantized_model_f = "./ckpt_int8.pt" # export.py 存的 int8 TorchScript model
+    quantized = False # 是否在 CPU 上用 int8 的 model 預測
+    embedding_f = "./embedding.npy" # main.py 存的 embedding 跟字典，不存在時才從 w2v model 建立
+    vocab_f = "./embedding_vocab.txt"
+    cache_dir = "./cache" # token store 跟句子轉成 index 的結果存放的位置
+    index_workers = 4 # 句子轉成 index 時平行的 process 數
 
     testing_data = sys.argv[1]
     output_f = sys.argv[2]
@@ -40,19 +51,29 @@ if __name__ == "__main__":
 
     # 開始測試模型並做預測
     # print("loading testing data ...")
-    test_x = load_testing_data(testing_data)
+    test_x = TokenStore(testing_data, 'test', cache_dir)
     
     preprocess = Preprocess(test_x, sen_len, w2v_path=w2v_path)
-    embedding = preprocess.make_embedding(load=True)
-    test_x = preprocess.sentence_word2idx()
-    test_dataset = TwitterDataset(X=test_x, y=None)
+    if os.path.exists(embedding_f) and os.path.exists(vocab_f):
+        embedding = preprocess.load_embedding(embedding_f, vocab_f)
+    else:
+        embedding = preprocess.make_embedding(load=True)
+        preprocess.save_embedding(embedding_f, vocab_f)
+    test_x = preprocess.sentence_word2idx(cache_dir, index_workers)
+    test_dataset = TwitterDataset(X=test_x, y=None, lengths=preprocess.sequence_lengths(test_x))
     test_loader = torch.utils.data.DataLoader(dataset = test_dataset,
                                                 batch_size = batch_size,
                                                 shuffle = False,
+                                                collate_fn = collate_batch,
                                                 num_workers = 8)
     # print('\nload model ...')
-    model = torch.load(model_f)
-    outputs = testing(batch_size, test_loader, model, 'cuda')
+    if quantized:
+        device = torch.device("cpu")
+        model = torch.jit.load(quantized_model_f)
+    else:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        model = torch.load(model_f, map_location=device)
+    outputs = testing(batch_size, test_loader, model, device)
 
     # 寫到 csv 檔案供上傳 Kaggle
     tmp = pd.DataFrame({"id":[str(i) for i in range(len(test_x))],"label":outputs})
@@ -0,0 +1,68 @@
+"""
+benchmark of the training-time decoder loop,
+compare Seq2Seq.forward (teacher-forced spans through Decoder.forward_sequence)
+with the original loop that calls the decoder one step at a time,
+on random sentences at several teacher forcing ratios (both decide once per step for the whole batch), with and without attention,
+print ms per batch of forward + backward
+"""
+import sys
+import time
+import random
+import torch
+import torch.nn as nn
+
+from train import Encoder, Decoder, Seq2Seq, schedule_sampling
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+batch_size = 60
+source_len = 30
+target_len = 30
+vocab_size = 3805        # hw8 中文字典大小 (英文字典也用相同大小)
+emb_dim, hid_dim, n_layers = 256, 512, 3
+warmup_steps = 2
+bench_steps = 10
+
+def stepwise_forward(model, input, target, teacher_forcing_ratio):
+  # 原本的訓練迴圈：每一步呼叫一次 decoder (含投影到字典)，整個 batch 一起決定是否用正確答案
+  batch_size, target_len = target.shape
+  outputs = torch.zeros(batch_size, target_len, model.decoder.cn_vocab_size, device=target.device)
+  encoder_outputs, hidden, keys, mask = model.encode(input)
+  input = target[:, 0]
+  for t in range(1, target_len):
+    output, hidden = model.decoder(input, hidden, encoder_outputs, keys, mask)
+    outputs[:, t] = output
+    top1 = output.argmax(1)
+    input = target[:, t] if random.random() <= teacher_forcing_ratio else top1
+  return outputs
+
+def bench(model, forward, ratio):
+  loss_function = nn.CrossEntropyLoss(ignore_index=0)
+  source = torch.randint(3, vocab_size, (batch_size, source_len), device=device)
+  target = torch.randint(3, vocab_size, (batch_size, target_len), device=device)
+  for step in range(warmup_steps + bench_steps):
+    if step == warmup_steps:
+      if device.type == 'cuda':
+        torch.cuda.synchronize()
+      start = time.perf_counter()
+    model.zero_grad(set_to_none=True)
+    outputs = forward(model, source, target, ratio)
+    loss = loss_function(outputs[:, 1:].reshape(-1, outputs.size(2)), target[:, 1:].reshape(-1))
+    loss.backward()
+  if device.type == 'cuda':
+    torch.cuda.synchronize()
+  return (time.perf_counter() - start) / bench_steps * 1000
+
+if __name__ == "__main__":
+  # 預設的 teacher forcing ratio 為 schedule_sampling 在訓練 0%, 50%, 80%, 100% 時的值
+  ratios = [float(r) for r in sys.argv[1:]] or [schedule_sampling(x) for x in (0.0, 0.5, 0.8, 1.0)]
+  torch.manual_seed(0)
+  random.seed(0)
+  print('attention  ratio  stepwise(ms)  spans(ms)  speedup')
+  for isatt in (True, False):
+    encoder = Encoder(vocab_size, emb_dim, hid_dim, n_layers, 0.5)
+    decoder = Decoder(vocab_size, emb_dim, hid_dim, n_layers, 0.5, isatt)
+    model = Seq2Seq(encoder, decoder, device).to(device).train()
+    for ratio in ratios:
+      stepwise = bench(model, stepwise_forward, ratio)
+      spans = bench(model, lambda m, s, t, r: m(s, t, r)[0], ratio)
+      print('%-9s  %5.2f  %12.1f  %9.1f  %7.2f' % (isatt, ratio, stepwise, spans, stepwise / spans))
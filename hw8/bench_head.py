@@ -0,0 +1,89 @@
+"""
+benchmark of the decoder output layer,
+compare the full softmax (Linear + CrossEntropyLoss) with the adaptive softmax
+on synthetic Zipf-distributed targets at the current and a 10x larger vocabulary,
+print tokens/sec of forward + backward and the memory used by the output layer
+"""
+import sys
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+features = 4096          # Decoder 最後一層的維度 (hid_dim * 2 * 4)
+tokens = 2048            # 每個 step 的 token 數 (batch size * target len)
+warmup_steps = 3
+bench_steps = 20
+cutoffs = (0.1, 0.4)
+
+def zipf_targets(vocab_size, n, seed=0):
+  # 依詞頻排序後的字典，第 k 個字的機率正比於 1 / k
+  p = 1.0 / np.arange(1, vocab_size + 1)
+  p /= p.sum()
+  return torch.as_tensor(np.random.RandomState(seed).choice(vocab_size, n, p=p), device=device)
+
+class FullHead(nn.Module):
+  def __init__(self, vocab_size):
+    super().__init__()
+    self.linear = nn.Linear(features, vocab_size)
+    self.loss_function = nn.CrossEntropyLoss()
+
+  def forward(self, x, y):
+    return self.loss_function(self.linear(x), y)
+
+class AdaptiveHead(nn.Module):
+  def __init__(self, vocab_size):
+    super().__init__()
+    self.adaptive = nn.AdaptiveLogSoftmaxWithLoss(features, vocab_size, [int(vocab_size * c) for c in cutoffs], div_value=4.0)
+
+  def forward(self, x, y):
+    return self.adaptive(x, y).loss
+
+def activation_bytes(head, x, y):
+  # autograd 為 backward 存下的 tensor 大小 (不含參數)
+  saved = []
+  def pack(t):
+    if not isinstance(t, nn.Parameter):
+      saved.append(t.numel() * t.element_size())
+    return t
+  with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+    loss = head(x, y)
+  loss.backward()
+  return sum(saved)
+
+def bench(head, vocab_size):
+  head = head.to(device)
+  x = torch.randn(tokens, features, device=device, requires_grad=True)
+  y = zipf_targets(vocab_size, tokens)
+  param_bytes = sum(p.numel() * p.element_size() for p in head.parameters())
+  if device.type == 'cuda':
+    torch.cuda.synchronize()
+    torch.cuda.reset_peak_memory_stats()
+    base = torch.cuda.memory_allocated()
+  act_bytes = activation_bytes(head, x, y)
+  for step in range(warmup_steps + bench_steps):
+    if step == warmup_steps:
+      if device.type == 'cuda':
+        torch.cuda.synchronize()
+      start = time.perf_counter()
+    head.zero_grad(set_to_none=True)
+    x.grad = None
+    head(x, y).backward()
+  if device.type == 'cuda':
+    torch.cuda.synchronize()
+    act_bytes = torch.cuda.max_memory_allocated() - base
+  elapsed = time.perf_counter() - start
+  return bench_steps * tokens / elapsed, param_bytes, act_bytes
+
+if __name__ == "__main__":
+  # 預設的字典大小是 hw8 中文字典 (3805) 跟它的 10 倍
+  vocab_sizes = [int(n) for n in sys.argv[1:]] or [3805, 38050]
+  print('vocab   head      tokens/s   speedup  params(MB)  activations(MB)')
+  for vocab_size in vocab_sizes:
+    base = None
+    for name, head in (('full', FullHead(vocab_size)), ('adaptive', AdaptiveHead(vocab_size))):
+      throughput, param_bytes, act_bytes = bench(head, vocab_size)
+      base = base or throughput
+      print('%6d  %-8s  %9.1f  %7.2f  %10.1f  %15.1f' % \
+        (vocab_size, name, throughput, throughput / base, param_bytes / 2**20, act_bytes / 2**20))
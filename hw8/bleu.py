@@ -0,0 +1,65 @@
+"""
+BLEU-1 engine for the validation / testing set
+the reference unigram counts are built once per dataset,
+hypotheses of a whole batch are scored with vectorized counting,
+the score equals nltk sentence_bleu(weights=(1, 0, 0, 0)) summed over sentences
+"""
+import numpy as np
+
+def cut_token(sentence):
+  # 中文的詞拆成字，英文、數字、<UNK> 保持原樣
+  tmp = []
+  for token in sentence:
+    if token == '<UNK>' or token.isdigit() or len(bytes(token[0], encoding='utf-8')) == 1:
+      tmp.append(token)
+    else:
+      tmp += [word for word in token]
+  return tmp
+
+class BleuScorer(object):
+  def __init__(self, references):
+    # references: 每句答案的 token list (tokens2sentence 的輸出)
+    self.vocab = {}
+    refs = [self.encode(cut_token(sentence), add=True) for sentence in references]
+    self.vocab_size = max(len(self.vocab), 1)
+    self.ref_len = np.array([len(ref) for ref in refs], dtype=np.int64)
+    # 將 (句子 index, 字 id) 編成一個整數 key，統計每個 key 在答案中出現的次數
+    sent = np.repeat(np.arange(len(refs), dtype=np.int64), self.ref_len)
+    ids = np.concatenate(refs) if refs else np.zeros(0, dtype=np.int64)
+    self.ref_keys, self.ref_counts = np.unique(sent * self.vocab_size + ids, return_counts=True)
+
+  def encode(self, sentence, add=False):
+    # 不在答案字典中的字給 -1，不可能對到任何答案
+    if add:
+      return np.array([self.vocab.setdefault(word, len(self.vocab)) for word in sentence], dtype=np.int64)
+    return np.array([self.vocab.get(word, -1) for word in sentence], dtype=np.int64)
+
+  def score(self, hypotheses, indices=None):
+    # hypotheses: 預測的 token list；indices: 每句預測對應的答案 index，預設依序對應
+    # 回傳每句 BLEU-1 的總和
+    n = len(hypotheses)
+    if n == 0:
+      return 0.0
+    indices = np.arange(n, dtype=np.int64) if indices is None else np.asarray(indices, dtype=np.int64)
+    hyps = [self.encode(cut_token(sentence)) for sentence in hypotheses]
+    hyp_len = np.array([len(hyp) for hyp in hyps], dtype=np.int64)
+    sent = np.repeat(np.arange(n, dtype=np.int64), hyp_len)
+    ids = np.concatenate(hyps)
+    keep = ids >= 0
+    sent, ids = sent[keep], ids[keep]
+
+    # 預測中每個 (句子, 字) 的次數，跟答案中同一個字的次數取 min (clipped count)
+    keys, counts = np.unique(sent * self.vocab_size + ids, return_counts=True)
+    ref_keys = indices[keys // self.vocab_size] * self.vocab_size + keys % self.vocab_size
+    pos = np.minimum(np.searchsorted(self.ref_keys, ref_keys), max(len(self.ref_keys) - 1, 0))
+    found = self.ref_keys[pos] == ref_keys if len(self.ref_keys) else np.zeros(len(keys), dtype=bool)
+    ref_counts = np.where(found, self.ref_counts[pos] if len(self.ref_keys) else 0, 0)
+    matches = np.bincount(keys // self.vocab_size, weights=np.minimum(counts, ref_counts), minlength=n)
+
+    # brevity penalty 跟 nltk 相同：c > r 為 1，否則 exp(1 - r / c)；沒有任何相同的字則為 0
+    r = self.ref_len[indices].astype(np.float64)
+    c = hyp_len.astype(np.float64)
+    c_safe = np.maximum(c, 1)
+    bp = np.where(c > r, 1.0, np.exp(1 - r / c_safe))
+    bleu = np.where((c > 0) & (matches > 0), bp * matches / c_safe, 0.0)
+    return float(bleu.sum())
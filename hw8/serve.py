@@ -0,0 +1,200 @@
+"""
+streaming translation service for hw8,
+keep the Seq2Seq model and the dictionaries loaded,
+read english sentences (one per line) from stdin or a local tcp socket,
+group concurrent requests into length-bucketed micro-batches under a latency budget,
+report p50 / p99 latency and throughput
+usage: python3 serve.py <data directory> [port]
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+from collections import deque
+import numpy as np
+import torch
+
+from test import configurations, build_model, build_quantized_model, tokens2sentence
+
+max_batch_size = 64      # 一個 micro-batch 最多幾句
+max_pending = 256        # 一次最多從 queue 取出幾句再依長度分 bucket
+max_wait = 0.01          # latency budget：第一句進來後最多等幾秒湊 batch
+bucket_width = 8         # 長度除以 bucket_width 相同的句子放進同一個 batch
+stats_window = 10000     # 計算 p50 / p99 時保留最近幾筆的延遲
+stats_f = "./serve_stats.json"
+
+class Stats(object):
+  def __init__(self):
+    self.start = time.perf_counter()
+    self.latencies = deque(maxlen=stats_window)
+    self.requests = 0
+    self.batches = 0
+
+  def record(self, latencies):
+    self.latencies.extend(latencies)
+    self.requests += len(latencies)
+    self.batches += 1
+
+  def summary(self):
+    latencies = np.array(self.latencies) * 1000 if self.latencies else np.zeros(1)
+    elapsed = time.perf_counter() - self.start
+    return {'requests': self.requests, 'batches': self.batches,
+            'avg_batch_size': self.requests / max(self.batches, 1),
+            'p50_ms': float(np.percentile(latencies, 50)), 'p99_ms': float(np.percentile(latencies, 99)),
+            'throughput': self.requests / elapsed}
+
+class Translator(object):
+  def __init__(self, config):
+    # 字典跟模型只在啟動時載入一次
+    self.config = config
+    with open(os.path.join(config.data_path, 'word2int_en.json'), "r") as f:
+      self.word2int_en = json.load(f)
+    with open(os.path.join(config.data_path, 'int2word_cn.json'), "r") as f:
+      self.int2word_cn = json.load(f)
+    self.bos, self.eos = self.word2int_en['<BOS>'], self.word2int_en['<EOS>']
+    self.unk, self.pad = self.word2int_en['<UNK>'], self.word2int_en['<PAD>']
+    en_vocab_size, cn_vocab_size = len(self.word2int_en), len(self.int2word_cn)
+    if config.quantize:
+      model = build_quantized_model(config, en_vocab_size, cn_vocab_size)
+    else:
+      model, _ = build_model(config, en_vocab_size, cn_vocab_size)
+    self.model = model.eval()
+
+  def encode(self, sentence):
+    # 跟 EN2CNDataset.tokenize 相同：以空白分詞，前後加上 <BOS>、<EOS>，超過 max_output_len 的部分截掉
+    sentence = sentence.split('\t')[0]
+    tokens = [self.bos] + [self.word2int_en.get(word, self.unk) for word in sentence.split(' ') if word] + [self.eos]
+    return tokens[:self.config.max_output_len]
+
+  @torch.no_grad()
+  def translate(self, batch):
+    # batch = encode 過的句子，補 <PAD> 到這個 batch 最長的長度後一起解碼
+    sources = np.full((len(batch), max(len(tokens) for tokens in batch)), self.pad, dtype=np.int64)
+    for i, tokens in enumerate(batch):
+      sources[i, :len(tokens)] = tokens
+    sources = torch.from_numpy(sources).to(self.model.device)
+    targets = torch.full((len(batch), 1), self.bos, dtype=torch.long, device=self.model.device)
+    _, preds = self.model.inference(sources, targets, self.config.beam_size, self.config.length_penalty,
+                                    self.config.max_output_len - 1, return_logits=False)
+    return [' '.join(sentence) for sentence in tokens2sentence(preds, self.int2word_cn)]
+
+class MicroBatcher(object):
+  def __init__(self, translator, stats):
+    self.translator = translator
+    self.stats = stats
+    self.queue = asyncio.Queue()
+
+  async def submit(self, sentence):
+    future = asyncio.get_running_loop().create_future()
+    await self.queue.put((self.translator.encode(sentence), time.perf_counter(), future))
+    return await future
+
+  async def collect(self):
+    # 等到第一句後，在 max_wait 內盡量多取；模型忙的時候 deadline 早就過了，直接取走 queue 裡所有的句子
+    pending = [await self.queue.get()]
+    deadline = pending[0][1] + max_wait
+    while len(pending) < max_pending:
+      timeout = deadline - time.perf_counter()
+      try:
+        if timeout <= 0:
+          pending.append(self.queue.get_nowait())
+        else:
+          pending.append(await asyncio.wait_for(self.queue.get(), timeout))
+      except (asyncio.QueueEmpty, asyncio.TimeoutError):
+        break
+    return pending
+
+  async def run(self):
+    # 模型在另一個 thread 執行，解碼時 event loop 仍然可以繼續收新的句子
+    loop = asyncio.get_running_loop()
+    while True:
+      pending = await self.collect()
+      buckets = {}
+      for request in pending:
+        buckets.setdefault(len(request[0]) // bucket_width, []).append(request)
+      for key in sorted(buckets):
+        bucket = buckets[key]
+        for i in range(0, len(bucket), max_batch_size):
+          batch = bucket[i:i + max_batch_size]
+          try:
+            translations = await loop.run_in_executor(None, self.translator.translate, [tokens for tokens, _, _ in batch])
+          except Exception as e:
+            for _, _, future in batch:
+              if not future.done():
+                future.set_exception(e)
+            continue
+          now = time.perf_counter()
+          for (_, _, future), translation in zip(batch, translations):
+            if not future.done():
+              future.set_result(translation)
+          self.stats.record([now - arrival for _, arrival, _ in batch])
+
+async def serve_lines(batcher, stats, readline, write):
+  # 每行一句英文，可以連續送很多句，回覆依照送出的順序；送 STATS 回傳延遲與吞吐量的統計 (json)
+  replies = asyncio.Queue()
+
+  async def reply():
+    while True:
+      future = await replies.get()
+      if future is None:
+        return
+      try:
+        write(await future + '\n')
+      except Exception as e:
+        write(f'ERROR {e}\n')
+
+  writer = asyncio.ensure_future(reply())
+  while True:
+    line = await readline()
+    if not line:
+      break
+    line = line.strip()
+    if not line:
+      continue
+    if line == 'STATS':
+      future = asyncio.get_running_loop().create_future()
+      future.set_result(json.dumps(stats.summary()))
+    else:
+      future = asyncio.ensure_future(batcher.submit(line))
+    await replies.put(future)
+  await replies.put(None)
+  await writer
+
+async def main(config, port):
+  stats = Stats()
+  batcher = MicroBatcher(Translator(config), stats)
+  worker = asyncio.ensure_future(batcher.run())
+  loop = asyncio.get_running_loop()
+  try:
+    if port is None:
+      def write(text):
+        sys.stdout.write(text)
+        sys.stdout.flush()
+      await serve_lines(batcher, stats, lambda: loop.run_in_executor(None, sys.stdin.readline), write)
+    else:
+      async def handle(reader, writer):
+        async def readline():
+          return (await reader.readline()).decode('utf-8')
+        await serve_lines(batcher, stats, readline, lambda text: writer.write(text.encode('utf-8')))
+        await writer.drain()
+        writer.close()
+
+      server = await asyncio.start_server(handle, '127.0.0.1', port)
+      print(f'serving on 127.0.0.1:{port}', file=sys.stderr)
+      async with server:
+        await server.serve_forever()
+  finally:
+    worker.cancel()
+    summary = stats.summary()
+    print(json.dumps(summary), file=sys.stderr)
+    with open(stats_f, 'w') as f:
+      json.dump(summary, f)
+
+if __name__ == '__main__':
+  config = configurations()
+  port = int(sys.argv[2]) if len(sys.argv) > 2 else None
+  try:
+    asyncio.run(main(config, port))
+  except KeyboardInterrupt:
+    pass
@@ -13,39 +13,81 @@ import os
 import random
 import json
 import re
+import hashlib
 
-import nltk
-from nltk.translate.bleu_score import sentence_bleu
-from nltk.translate.bleu_score import SmoothingFunction
+from bleu import BleuScorer
 
 import math
+import time
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu") # 判斷是用 CPU 還是 GPU 執行運算
 
-# 將不同長度的答案拓展到相同長度，以便訓練模型
+# 將同一個 batch 中不同長度的句子拓展到相同長度，以便訓練模型 (當作 DataLoader 的 collate_fn)
 class LabelTransform(object):
   def __init__(self, size, pad):
     self.size = size
     self.pad = pad
 
-  def __call__(self, label):
-    label = np.pad(label, (0, (self.size - label.shape[0])), mode='constant', constant_values=self.pad)
-    return label
+  def __call__(self, batch):
+    # batch = [(en, cn), ...]
+    en, cn = zip(*batch)
+    return self.pad_batch(en), self.pad_batch(cn)
+
+  def pad_batch(self, labels):
+    # 只補到這個 batch 中最長句子的長度 (最多 size)，預先配置好填滿 <PAD> 的陣列再把句子複製進去
+    length = min(max(label.shape[0] for label in labels), self.size)
+    ret = np.full((len(labels), length), self.pad, dtype=np.int64)
+    for i, label in enumerate(labels):
+      n = min(label.shape[0], length)
+      ret[i, :n] = label[:n]
+    return torch.from_numpy(ret)
+
+# 將長度相近的句子放進同一個 batch，減少 <PAD> 造成的多餘計算
+class BucketBatchSampler(sampler.Sampler):
+  def __init__(self, lengths, batch_size, shuffle=True, bucket_size=100, indices=None):
+    self.lengths = np.asarray(lengths)
+    self.batch_size = batch_size
+    self.shuffle = shuffle
+    self.bucket_size = bucket_size    # 每 bucket_size 個 batch 的資料為一個 bucket
+    # 只從這些 index 中取資料 (e.g. 驗證集的固定子集)，預設為全部
+    self.indices = np.arange(len(self.lengths)) if indices is None else np.asarray(indices)
+
+  def __iter__(self):
+    if self.shuffle:
+      # 先打亂，再在每個 bucket 裡依長度排序後切成 batch，最後打亂 batch 的順序
+      order = np.random.permutation(self.indices)
+      chunk = self.batch_size * self.bucket_size
+      batches = []
+      for i in range(0, len(order), chunk):
+        bucket = order[i:i + chunk]
+        bucket = bucket[np.argsort(self.lengths[bucket], kind='stable')]
+        batches += [bucket[j:j + self.batch_size] for j in range(0, len(bucket), self.batch_size)]
+      random.shuffle(batches)
+    else:
+      order = self.indices[np.argsort(self.lengths[self.indices], kind='stable')]
+      batches = [order[j:j + self.batch_size] for j in range(0, len(order), self.batch_size)]
+    for batch in batches:
+      yield batch.tolist()
+
+  def __len__(self):
+    return (len(self.indices) + self.batch_size - 1) // self.batch_size
 
 
 class EN2CNDataset(data.Dataset):
-  def __init__(self, root, max_output_len, set_name):
+  def __init__(self, root, max_output_len, set_name, cache_path=None):
     self.root = root
+    self.cache_path = cache_path if cache_path is not None else root
 
     self.word2int_cn, self.int2word_cn = self.get_dictionary('cn')
     self.word2int_en, self.int2word_en = self.get_dictionary('en')
 
     # 載入資料
-    self.data = []
-    with open(os.path.join(self.root, f'{set_name}.txt'), "r") as f:
-      for line in f:
-        self.data.append(line)
-    print (f'{set_name} dataset size: {len(self.data)}')
+    # 第一次使用時將句子轉成整數存成 .npy (所有 token 接成一維陣列 + 每句的 offset)，之後直接 memory-map
+    self.en, self.en_offsets, self.cn, self.cn_offsets = self.load_corpus(set_name)
+    self.max_output_len = max_output_len
+    print (f'{set_name} dataset size: {len(self)}')
+    # 每句 (中英文取較長者) 的長度，給 BucketBatchSampler 用
+    self.lengths = np.minimum(np.maximum(np.diff(self.en_offsets), np.diff(self.cn_offsets)), max_output_len)
 
     self.cn_vocab_size = len(self.word2int_cn)
     self.en_vocab_size = len(self.word2int_en)
@@ -59,46 +101,57 @@ class EN2CNDataset(data.Dataset):
       int2word = json.load(f)
     return word2int, int2word
 
-  def __len__(self):
-    return len(self.data)
-
-  def __getitem__(self, Index):
-    # 先將中英文分開
-    sentences = self.data[Index]
-    sentences = re.split('[\t\n]', sentences)
-    sentences = list(filter(None, sentences))
-    #print (sentences)
-    assert len(sentences) == 2
-
+  def load_corpus(self, set_name):
+    sources = [os.path.join(self.root, f'{name}.json') for name in ('word2int_en', 'word2int_cn')]
+    sources.append(os.path.join(self.root, f'{set_name}.txt'))
+    # cache 的檔名帶有原始檔案跟字典的路徑、大小、修改時間的 hash，換了 data_path 或檔案改過都會用不同的 cache
+    key = hashlib.sha1('|'.join('{}:{}:{}'.format(os.path.abspath(path), os.path.getsize(path), os.path.getmtime(path))
+                                for path in sources).encode('utf-8')).hexdigest()[:16]
+    paths = [os.path.join(self.cache_path, f'{set_name}_{key}_{name}.npy') for name in ('en', 'en_offsets', 'cn', 'cn_offsets')]
+    if not all(os.path.exists(path) for path in paths):
+      os.makedirs(self.cache_path, exist_ok=True)
+      for path, array in zip(paths, self.tokenize(sources[-1])):
+        np.save(path, array)
+    return [np.load(path, mmap_mode='r') for path in paths]
+
+  def tokenize(self, path):
     # 預備特殊字元
     BOS = self.word2int_en['<BOS>']
     EOS = self.word2int_en['<EOS>']
     UNK = self.word2int_en['<UNK>']
 
-    # 在開頭添加 <BOS>，在結尾添加 <EOS> ，不在字典的 subword (詞) 用 <UNK> 取代
-    en, cn = [BOS], [BOS]
-    # 將句子拆解為 subword 並轉為整數
-    sentence = re.split(' ', sentences[0])
-    sentence = list(filter(None, sentence))
-    #print (f'en: {sentence}')
-    for word in sentence:
-      en.append(self.word2int_en.get(word, UNK))
-    en.append(EOS)
-
-    # 將句子拆解為單詞並轉為整數
-    # e.g. < BOS >, we, are, friends, < EOS > --> 1, 28, 29, 205, 2
-    sentence = re.split(' ', sentences[1])
-    sentence = list(filter(None, sentence))
-    #print (f'cn: {sentence}')
-    for word in sentence:
-      cn.append(self.word2int_cn.get(word, UNK))
-    cn.append(EOS)
-
-    en, cn = np.asarray(en), np.asarray(cn)
-
-    # 用 <PAD> 將句子補到相同長度
-    en, cn = self.transform(en), self.transform(cn)
-    en, cn = torch.LongTensor(en), torch.LongTensor(cn)
+    en, cn = [], []
+    en_offsets, cn_offsets = [0], [0]
+    with open(path, "r") as f:
+      for line in f:
+        # 先將中英文分開
+        sentences = re.split('[\t\n]', line)
+        sentences = list(filter(None, sentences))
+        assert len(sentences) == 2
+        # 在開頭添加 <BOS>，在結尾添加 <EOS> ，不在字典的 subword (詞) 用 <UNK> 取代
+        # e.g. < BOS >, we, are, friends, < EOS > --> 1, 28, 29, 205, 2
+        for sentence, word2int, tokens, offsets in ((sentences[0], self.word2int_en, en, en_offsets),
+                                                     (sentences[1], self.word2int_cn, cn, cn_offsets)):
+          tokens.append(BOS)
+          tokens.extend(word2int.get(word, UNK) for word in re.split(' ', sentence) if word)
+          tokens.append(EOS)
+          offsets.append(len(tokens))
+    return (np.array(en, dtype=np.int32), np.array(en_offsets, dtype=np.int64),
+            np.array(cn, dtype=np.int32), np.array(cn_offsets, dtype=np.int64))
+
+  def references(self):
+    # 每句中文答案 (去掉 <BOS>、<EOS>，跟 tokens2sentence 的結果相同)，計算 BLEU 用
+    return [[self.int2word_cn[str(token)] for token in
+             self.cn[self.cn_offsets[i] + 1:min(self.cn_offsets[i + 1] - 1, self.cn_offsets[i] + self.max_output_len)].tolist()]
+            for i in range(len(self))]
+
+  def __len__(self):
+    return len(self.en_offsets) - 1
+
+  def __getitem__(self, Index):
+    # 用 <PAD> 將句子補到相同長度交給 collate_fn (self.transform) 在組 batch 時處理
+    en = self.en[self.en_offsets[Index]:self.en_offsets[Index + 1]]
+    cn = self.cn[self.cn_offsets[Index]:self.cn_offsets[Index + 1]]
 
     return en, cn
 
@@ -122,12 +175,12 @@ class Encoder(nn.Module):
     return outputs, hidden
 
 class Decoder(nn.Module):
-  def __init__(self, cn_vocab_size, emb_dim, hid_dim, n_layers, dropout, isatt):
+  def __init__(self, cn_vocab_size, emb_dim, hid_dim, n_layers, dropout, isatt, head='full', cutoffs=(0.1, 0.4)):
     super().__init__()
     self.cn_vocab_size = cn_vocab_size
     self.hid_dim = hid_dim * 2
     self.n_layers = n_layers
-    self.embedding = nn.Embedding(cn_vocab_size, config.emb_dim)
+    self.embedding = nn.Embedding(cn_vocab_size, emb_dim)
     self.isatt = isatt
     self.attention = Attention(hid_dim)
     # 如果使用 Attention Mechanism 會使得輸入維度變化，請在這裡修改
@@ -137,7 +190,16 @@ class Decoder(nn.Module):
     self.rnn = nn.GRU(self.input_dim, self.hid_dim, self.n_layers, dropout = dropout, batch_first=True)
     self.embedding2vocab1 = nn.Linear(self.hid_dim, self.hid_dim * 2)
     self.embedding2vocab2 = nn.Linear(self.hid_dim * 2, self.hid_dim * 4)
-    self.embedding2vocab3 = nn.Linear(self.hid_dim * 4, self.cn_vocab_size)
+    # head = 'full': 完整的 softmax；'adaptive': 依詞頻分群的 adaptive softmax，訓練時只需計算常用詞與目標所在的群
+    # cutoffs 為各群的邊界佔字典大小的比例，字典需先用 set_frequency 依詞頻排序
+    self.head = head
+    if head == 'adaptive':
+      self.adaptive = nn.AdaptiveLogSoftmaxWithLoss(self.hid_dim * 4, self.cn_vocab_size,
+                                                    [int(self.cn_vocab_size * c) for c in cutoffs], div_value=4.0)
+      self.register_buffer('vocab2rank', torch.arange(self.cn_vocab_size))
+      self.register_buffer('rank2vocab', torch.arange(self.cn_vocab_size))
+    else:
+      self.embedding2vocab3 = nn.Linear(self.hid_dim * 4, self.cn_vocab_size)
     self.dropout = nn.Dropout(dropout)
 
     # self.ff = nn.Sequential(nn.Linear(self.input_dim, int(self.input_dim / 2)),
@@ -146,61 +208,119 @@ class Decoder(nn.Module):
     #                         nn.Linear(int(self.input_dim / 2), self.input_dim),
     #                         )
 
-  def forward(self, input, hidden, encoder_outputs):
-    # input = [batch size, vocab size]
-    # hidden = [batch size, n layers * directions, hid dim]
-    # Decoder 只會是單向，所以 directions=1
-    input = input.unsqueeze(1)
-    embedded = self.dropout(self.embedding(input))
+  def set_frequency(self, counts):
+    # counts = 每個字在訓練資料中出現的次數，adaptive softmax 依詞頻由高到低重新編號
+    rank2vocab = torch.as_tensor(np.argsort(-np.asarray(counts), kind='stable'), device=self.rank2vocab.device)
+    self.rank2vocab.copy_(rank2vocab)
+    self.vocab2rank[rank2vocab] = torch.arange(self.cn_vocab_size, device=self.vocab2rank.device)
+
+  def project(self, features):
+    # features = [batch size, hid dim * 4] -> [batch size, vocab size]
+    # adaptive softmax 回傳完整字典的 log probability (inference 時與 full softmax 一樣是精確值)
+    if self.head == 'adaptive':
+      return self.adaptive.log_prob(features)[:, self.vocab2rank]
+    return self.embedding2vocab3(features)
+
+  def predict(self, features):
+    # 機率最大的字，adaptive softmax 只在需要時才計算其他群
+    if self.head == 'adaptive':
+      return self.rank2vocab[self.adaptive.predict(features)]
+    return self.embedding2vocab3(features).argmax(1)
+
+  def loss(self, outputs, targets, loss_function):
+    # outputs = Seq2Seq.forward 的輸出 (full: logits，adaptive: features)，targets = [batch size, target len]
+    if self.head == 'adaptive':
+      mask = targets != 0
+      return self.adaptive(outputs[mask], self.vocab2rank[targets[mask]]).loss
+    return loss_function(outputs.reshape(-1, outputs.size(-1)), targets.reshape(-1))
+
+  def rnn_step(self, embedded, hidden, encoder_outputs, keys=None, mask=None):
     # embedded = [batch size, 1, emb dim]
     if self.isatt:
-      attn = self.attention(encoder_outputs, hidden)  # [batch size, 1, hid dim * dir]
+      attn = self.attention(encoder_outputs, hidden, keys, mask)  # [batch size, 1, hid dim * dir]
       # TODO: 在這裡決定如何使用 Attention，e.g. 相加 或是 接在後面， 請注意維度變化
       embedded = torch.cat((embedded, attn), 2) # [batch size, 1, emb dim + hid dim * dir]
       # embedded = self.ff(embedded) # 傳入feedforward network
     
-    output, hidden = self.rnn(embedded, hidden)
+    return self.rnn(embedded, hidden)
+
+  def features(self, output):
+    # 將 RNN 的輸出轉為 embedding2vocab 的 features，最後一維之前的維度不限
+    return self.embedding2vocab2(self.embedding2vocab1(output))
+
+  def forward(self, input, hidden, encoder_outputs, keys=None, mask=None, features_only=False):
+    # input = [batch size, vocab size]
+    # hidden = [batch size, n layers * directions, hid dim]
+    # Decoder 只會是單向，所以 directions=1
+    input = input.unsqueeze(1)
+    embedded = self.dropout(self.embedding(input))
+    # embedded = [batch size, 1, emb dim]
+    output, hidden = self.rnn_step(embedded, hidden, encoder_outputs, keys, mask)
     # output = [batch size, 1, hid dim]
     # hidden = [num_layers, batch size, hid dim]
 
     # 將 RNN 的輸出轉為每個詞出現的機率
-    output = self.embedding2vocab1(output.squeeze(1))
-    output = self.embedding2vocab2(output)
-    prediction = self.embedding2vocab3(output)
+    output = self.features(output.squeeze(1))
+    if features_only:
+      return output, hidden
+    prediction = self.project(output)
     # prediction = [batch size, vocab size]
     return prediction, hidden
 
+  def forward_sequence(self, inputs, sample, hidden, encoder_outputs, keys=None, mask=None, features_only=False):
+    # 訓練時一次處理整句的輸入，回傳每一步的輸出 = [batch size, len, vocab size] (features_only 時為 features)
+    # inputs = [batch size, len] 正確答案的輸入 (<BOS> + 答案去掉最後一個字)
+    # sample = 長度 len 的 list，True 的那一步整個 batch 改用上一步預測的字當輸入 (scheduled sampling)，第 0 步必須是 False
+    # 兩個 sample 的步驟之間，輸入都是已知的：embedding 一次查完，整段一次投影到字典；
+    # 沒有 attention 時整段只呼叫一次 GRU，有 attention 時每一步都要用上一步的 hidden，GRU 只能逐步執行
+    length = inputs.size(1)
+    embedded = self.dropout(self.embedding(inputs))
+    starts = [t for t in range(length) if t == 0 or sample[t]] + [length]
+    outputs = []
+    for start, end in zip(starts[:-1], starts[1:]):
+      segment = embedded[:, start:end]
+      if sample[start]:
+        # 上一段最後一步的輸出已經算好，直接取機率最大的字
+        with torch.no_grad():
+          top1 = self.predict(outputs[-1][:, -1]) if features_only else outputs[-1][:, -1].argmax(1)
+        segment = torch.cat((self.dropout(self.embedding(top1)).unsqueeze(1), segment[:, 1:]), 1)
+      if self.isatt:
+        output = []
+        for t in range(end - start):
+          step, hidden = self.rnn_step(segment[:, t:t + 1], hidden, encoder_outputs, keys, mask)
+          output.append(step)
+        output = torch.cat(output, 1)
+      else:
+        output, hidden = self.rnn(segment, hidden)
+      output = self.features(output)
+      outputs.append(output if features_only else self.project(output))
+    return torch.cat(outputs, 1), hidden
+
 class Attention(nn.Module):
   def __init__(self, hid_dim):
     super(Attention, self).__init__()
     self.hid_dim = hid_dim
+
+  def keys(self, encoder_outputs):
+    # 每個 source batch 只需要算一次：將 encoder outputs normalize 成單位向量，之後每一步的 cosine similarity 只剩一次 bmm
+    # encoder_outputs = [batch size, sequence len, hid dim * directions]
+    return F.normalize(encoder_outputs, dim=2, eps=1e-8)
   
-  def forward(self, encoder_outputs, decoder_hidden):
+  def forward(self, encoder_outputs, decoder_hidden, keys=None, mask=None):
     # encoder_outputs = [batch size, sequence len, hid dim * directions]
     # decoder_hidden = [num_layers, batch size, hid dim]
-    # 一般來說是取 Encoder 最後一層的 hidden state 來做 attention
-    ########
-    # TODO #
-    ########
-    h = torch.transpose(encoder_outputs, 0, 1)
-    h = torch.transpose(h, 1, 2) # [seq len, hid dim * dir, batch size]
-    
-    z = torch.transpose(decoder_hidden, 1 , 2) # [num layer, hid dim, batch size]
-    z = z[[0], :, :] # 取最後一層hidden layer
-    
-    alpha = F.cosine_similarity(h, z) # [seq len, batchsize]
-    alpha = nn.Softmax(dim = 0)(alpha) # softmax over seq len axis, [seq len, batch size]
-    
-    
-    alpha = torch.unsqueeze(alpha, 1) # [seq len, 1 , batchsize]
-    alpha = alpha.expand(h.shape[0], h.shape[1], h.shape[2]) # [seq len, hid dim * dir, batch size]
-
-    attention = alpha * h
-    attention = torch.sum(attention, dim = 0) # [hid dim*dir, batch size]
-    
-    attention = torch.transpose(attention, 0, 1) # [batch size, hid dim * dir]
-    attention = torch.unsqueeze(attention, 1) # [batch size, 1, hid dim * dir]
-    # attention=None
+    # keys = self.keys(encoder_outputs)
+    # mask = [batch size, sequence len]，<PAD> 的位置為 False
+    if keys is None:
+      keys = self.keys(encoder_outputs)
+    z = F.normalize(decoder_hidden[0], dim=1, eps=1e-8) # 取第一層 hidden layer, [batch size, hid dim]
+
+    alpha = torch.bmm(keys, z.unsqueeze(2)).squeeze(2) # cosine similarity, [batch size, seq len]
+    if mask is not None:
+      alpha = alpha.masked_fill(~mask, float('-inf'))
+    alpha = F.softmax(alpha, dim=1) # softmax over seq len axis, [batch size, seq len]
+
+    attention = torch.bmm(alpha.unsqueeze(1), encoder_outputs) # [batch size, 1, hid dim * dir]
     
     return attention
 
@@ -210,77 +330,80 @@ class Seq2Seq(nn.Module):
     self.encoder = encoder
     self.decoder = decoder
     self.device = device
+    self.pad = 0 # <PAD> 在字典中的 index
+    self.eos = 2 # <EOS> 在字典中的 index
     assert encoder.n_layers == decoder.n_layers, \
             "Encoder and decoder must have equal number of layers!"
             
-  def forward(self, input, target, teacher_forcing_ratio):
+  def encode(self, input):
     # input  = [batch size, input len, vocab size]
-    # target = [batch size, target len, vocab size]
-    # teacher_forcing_ratio 是有多少機率使用正確答案來訓練
-    batch_size = target.shape[0]
-    target_len = target.shape[1]
-    vocab_size = self.decoder.cn_vocab_size
-
-    # 準備一個儲存空間來儲存輸出
-    outputs = torch.zeros(batch_size, target_len, vocab_size).to(self.device)
+    batch_size = input.shape[0]
     # 將輸入放入 Encoder
     encoder_outputs, hidden = self.encoder(input)
+    # attention 用的 key 跟 source 的 padding mask 每個 batch 只算一次
+    keys, mask = self.decoder.attention.keys(encoder_outputs), input != self.pad
     # Encoder 最後的隱藏層(hidden state) 用來初始化 Decoder
     # encoder_outputs 主要是使用在 Attention
     # 因為 Encoder 是雙向的RNN，所以需要將同一層兩個方向的 hidden state 接在一起
     # hidden =  [num_layers * directions, batch size  , hid dim]  --> [num_layers, directions, batch size  , hid dim]
     hidden = hidden.view(self.encoder.n_layers, 2, batch_size, -1)
     hidden = torch.cat((hidden[:, -2, :, :], hidden[:, -1, :, :]), dim=2)
-    # 取的 <BOS> token
-    input = target[:, 0]
-    preds = []
-    for t in range(1, target_len):
-      output, hidden = self.decoder(input, hidden, encoder_outputs)
-      outputs[:, t] = output
-      # 決定是否用正確答案來做訓練
-      teacher_force = random.random() <= teacher_forcing_ratio
-      # 取出機率最大的單詞
-      top1 = output.argmax(1)
-      # 如果是 teacher force 則用正解訓練，反之用自己預測的單詞做預測
-      input = target[:, t] if teacher_force and t < target_len else top1
-      preds.append(top1.unsqueeze(1))
-    preds = torch.cat(preds, 1)
+    return encoder_outputs, hidden, keys, mask
+
+  def forward(self, input, target, teacher_forcing_ratio):
+    # input  = [batch size, input len, vocab size]
+    # target = [batch size, target len, vocab size]
+    # teacher_forcing_ratio 是有多少機率使用正確答案來訓練，每一步整個 batch 一起決定
+    batch_size = target.shape[0]
+    target_len = target.shape[1]
+
+    encoder_outputs, hidden, keys, mask = self.encode(input)
+    # 第 t 步的輸入是 target[:, t - 1] (第 1 步為 <BOS>)，sample 為 True 時改用第 t - 1 步預測的字
+    sample = [t > 0 and random.random() > teacher_forcing_ratio for t in range(target_len - 1)]
+    # adaptive softmax 訓練時只存 decoder 的 features，loss 由 decoder.loss 一次計算
+    adaptive = self.decoder.head == 'adaptive'
+    outputs, hidden = self.decoder.forward_sequence(target[:, :-1], sample, hidden, encoder_outputs, keys, mask, features_only=adaptive)
+    if adaptive:
+      with torch.no_grad():
+        preds = self.decoder.predict(outputs.reshape(-1, outputs.size(2))).view(batch_size, -1)
+    else:
+      preds = outputs.argmax(2)
+    # 第 0 步沒有輸出，補 0 讓 outputs 跟 target 對齊
+    outputs = torch.cat((outputs.new_zeros(batch_size, 1, outputs.size(2)), outputs), 1)
     return outputs, preds
 
-  def inference(self, input, target):
-    ########
-    # TODO #
-    ########
-    # 在這裡實施 Beam Search
-    # 此函式的 batch size = 1  
+  def inference(self, input, target, max_len=None, return_logits=True):
     # input  = [batch size, input len, vocab size]
     # target = [batch size, target len, vocab size]
+    # 最多解碼 max_len 個字，整個 batch 都輸出 <EOS> 就提早結束；解碼長度跟答案長度無關，答案只用來算 loss
+    # return_logits 為 True 時 (要算 loss) 另外保留前 target len - 1 步完整的輸出，loss 只算這些位置
     batch_size = input.shape[0]
-    input_len = input.shape[1]        # 取得最大字數
+    target_len = target.shape[1]
     vocab_size = self.decoder.cn_vocab_size
+    max_len = max_len if max_len is not None else target_len - 1
+    # 算 loss 時至少要跑完 target len - 1 步
+    steps = max(max_len, target_len - 1) if return_logits else max_len
 
     # 準備一個儲存空間來儲存輸出
-    outputs = torch.zeros(batch_size, input_len, vocab_size).to(self.device)
-    # 將輸入放入 Encoder
-    encoder_outputs, hidden = self.encoder(input)
-    # Encoder 最後的隱藏層(hidden state) 用來初始化 Decoder
-    # encoder_outputs 主要是使用在 Attention
-    # 因為 Encoder 是雙向的RNN，所以需要將同一層兩個方向的 hidden state 接在一起
-    # hidden =  [num_layers * directions, batch size  , hid dim]  --> [num_layers, directions, batch size  , hid dim]
-    hidden = hidden.view(self.encoder.n_layers, 2, batch_size, -1)
-    hidden = torch.cat((hidden[:, -2, :, :], hidden[:, -1, :, :]), dim=2)
+    outputs = torch.zeros(batch_size, target_len, vocab_size, device=input.device) if return_logits else None
+    preds = torch.full((batch_size, max_len), self.eos, dtype=torch.long, device=input.device)
+    finished = torch.zeros(batch_size, dtype=torch.bool, device=input.device)
+    encoder_outputs, hidden, keys, mask = self.encode(input)
     # 取的 <BOS> token
     input = target[:, 0]
-    preds = []
-    for t in range(1, input_len):
-      output, hidden = self.decoder(input, hidden, encoder_outputs)
+    for t in range(1, steps + 1):
+      output, hidden = self.decoder(input, hidden, encoder_outputs, keys, mask)
       # 將預測結果存起來
-      outputs[:, t] = output
+      if return_logits and t < target_len:
+        outputs[:, t] = output
       # 取出機率最大的單詞
       top1 = output.argmax(1)
+      if t <= max_len:
+        preds[:, t - 1] = top1
       input = top1
-      preds.append(top1.unsqueeze(1))
-    preds = torch.cat(preds, 1)
+      finished |= top1 == self.eos
+      if finished.all() and (not return_logits or t >= target_len - 1):
+        break
     
     return outputs, preds
 
@@ -291,13 +414,14 @@ def save_model(model, optimizer, store_model_path, step):
 
 def load_model(model, load_model_path):
   print(f'Load model from {load_model_path}')
-  model.load_state_dict(torch.load(f'{load_model_path}.ckpt'))
+  model.load_state_dict(torch.load(f'{load_model_path}.ckpt', map_location='cpu'))
   return model
 
-def build_model(config, en_vocab_size, cn_vocab_size):
+def build_model(config, en_vocab_size, cn_vocab_size, device=device):
   # 建構模型
   encoder = Encoder(en_vocab_size, config.emb_dim, config.hid_dim, config.n_layers, config.dropout)
-  decoder = Decoder(cn_vocab_size, config.emb_dim, config.hid_dim, config.n_layers, config.dropout, config.attention)
+  decoder = Decoder(cn_vocab_size, config.emb_dim, config.hid_dim, config.n_layers, config.dropout, config.attention,
+                    config.output_head, config.adaptive_cutoffs)
   model = Seq2Seq(encoder, decoder, device)
   print(model)
   # 建構 optimizer
@@ -310,11 +434,12 @@ def build_model(config, en_vocab_size, cn_vocab_size):
   return model, optimizer
 
 def tokens2sentence(outputs, int2word):
+  # outputs = [batch size, len] 的 token tensor，一次搬回 cpu 轉成 list 再查字典
   sentences = []
-  for tokens in outputs:
+  for tokens in outputs.tolist():
     sentence = []
     for token in tokens:
-      word = int2word[str(int(token))]
+      word = int2word[str(token)]
       if word == '<EOS>':
         break
       sentence.append(word)
@@ -325,24 +450,9 @@ def tokens2sentence(outputs, int2word):
 
 
 def computebleu(sentences, targets):
-  score = 0 
   assert (len(sentences) == len(targets))
-
-  def cut_token(sentence):
-    tmp = []
-    for token in sentence:
-      if token == '<UNK>' or token.isdigit() or len(bytes(token[0], encoding='utf-8')) == 1:
-        tmp.append(token)
-      else:
-        tmp += [word for word in token]
-    return tmp 
-
-  for sentence, target in zip(sentences, targets):
-    sentence = cut_token(sentence)
-    target = cut_token(target)
-    score += sentence_bleu([target], sentence, weights=(1, 0, 0, 0))                                                                                          
-  
-  return score
+  # 跟 nltk sentence_bleu(weights=(1, 0, 0, 0)) 相同的分數，同一個資料集重複計算時請直接使用 BleuScorer
+  return BleuScorer(targets).score(sentences)
 
 def infinite_iter(data_loader):
   it = iter(data_loader)
@@ -378,9 +488,7 @@ def train(model, optimizer, train_iter, loss_function, total_steps, summary_step
     sources, targets = sources.to(device), targets.to(device)
     outputs, preds = model(sources, targets, schedule_sampling((step+total_steps)/num_steps))
     # targets 的第一個 token 是 <BOS> 所以忽略
-    outputs = outputs[:, 1:].reshape(-1, outputs.size(2))
-    targets = targets[:, 1:].reshape(-1)
-    loss = loss_function(outputs, targets)
+    loss = model.decoder.loss(outputs[:, 1:], targets[:, 1:], loss_function)
     
     optimizer.zero_grad()
     loss.backward()
@@ -396,61 +504,90 @@ def train(model, optimizer, train_iter, loss_function, total_steps, summary_step
 
   return model, optimizer, losses
 
-def test(model, dataloader, loss_function):
+@torch.no_grad()
+def test(model, dataloader, loss_function, max_len=None, compute_loss=True, scorer=None):
   model.eval()
   loss_sum, bleu_score= 0.0, 0.0
   n = 0
   result = []
-  for sources, targets in dataloader:
-    sources, targets = sources.to(device), targets.to(device)
+  # 答案的 unigram 統計整個資料集只建一次
+  if scorer is None:
+    scorer = BleuScorer(dataloader.dataset.references())
+  # batch 可能依長度重新排列過，記下每筆資料原本的 index，最後再照原本的順序排回來
+  order = []
+  for indices, (sources, targets) in zip(dataloader.batch_sampler, dataloader):
+    order += indices
+    sources, targets = sources.to(model.device), targets.to(model.device)
     batch_size = sources.size(0)
-    outputs, preds = model.inference(sources, targets)
+    outputs, preds = model.inference(sources, targets, max_len, compute_loss)
     # targets 的第一個 token 是 <BOS> 所以忽略
-    outputs = outputs[:, 1:].reshape(-1, outputs.size(2))
-    targets = targets[:, 1:].reshape(-1)
-
-    loss = loss_function(outputs, targets)
-    loss_sum += loss.item()
+    targets = targets[:, 1:]
+    if compute_loss:
+      loss = loss_function(outputs[:, 1:].reshape(-1, outputs.size(2)), targets.reshape(-1))
+      loss_sum += loss.item()
 
     # 將預測結果轉為文字
-    targets = targets.view(sources.size(0), -1)
     preds = tokens2sentence(preds, dataloader.dataset.int2word_cn)
     sources = tokens2sentence(sources, dataloader.dataset.int2word_en)
     targets = tokens2sentence(targets, dataloader.dataset.int2word_cn)
     for source, pred, target in zip(sources, preds, targets):
       result.append((source, pred, target))
     # 計算 Bleu Score
-    bleu_score += computebleu(preds, targets)
+    bleu_score += scorer.score(preds, indices)
 
     n += batch_size
 
-  return loss_sum / len(dataloader), bleu_score / n, result
+  result = [line for _, line in sorted(zip(order, result), key=lambda x: x[0])]
+  return (loss_sum / len(dataloader) if compute_loss else None), bleu_score / n, result
 
 def train_process(config):
   # 準備訓練資料
-  train_dataset = EN2CNDataset(config.data_path, config.max_output_len, 'training')
-  train_loader = data.DataLoader(train_dataset, batch_size=config.batch_size, shuffle=True)
+  train_dataset = EN2CNDataset(config.data_path, config.max_output_len, 'training', config.cache_path)
+  train_loader = data.DataLoader(train_dataset, batch_sampler=BucketBatchSampler(train_dataset.lengths, config.batch_size),
+                                 collate_fn=train_dataset.transform)
   train_iter = infinite_iter(train_loader)
   # 準備檢驗資料
-  val_dataset = EN2CNDataset(config.data_path, config.max_output_len, 'validation')
-  val_loader = data.DataLoader(val_dataset, batch_size=1)
+  val_dataset = EN2CNDataset(config.data_path, config.max_output_len, 'validation', config.cache_path)
+  val_loader = data.DataLoader(val_dataset, batch_sampler=BucketBatchSampler(val_dataset.lengths, config.val_batch_size, shuffle=False),
+                               collate_fn=val_dataset.transform)
+  # 每次都在固定的隨機子集上驗證，每 full_val_steps 次與訓練結束時另外跑完整的驗證集
+  val_subset = np.random.RandomState(0).permutation(len(val_dataset))[:config.val_subset] if config.val_subset else None
+  val_subset_loader = data.DataLoader(val_dataset, batch_sampler=BucketBatchSampler(val_dataset.lengths, config.val_batch_size, shuffle=False, indices=val_subset),
+                                      collate_fn=val_dataset.transform)
   # 建構模型
   model, optimizer = build_model(config, train_dataset.en_vocab_size, train_dataset.cn_vocab_size)
+  if config.output_head == 'adaptive' and not config.load_model:
+    model.decoder.set_frequency(np.bincount(train_dataset.cn, minlength=train_dataset.cn_vocab_size))
   loss_function = nn.CrossEntropyLoss(ignore_index=0)
+  val_scorer = BleuScorer(val_dataset.references())
 
-  train_losses, val_losses, bleu_scores = [], [], []
+  train_losses, val_losses, bleu_scores, full_val = [], [], [], []
   total_steps = 0
+  train_time, val_time = 0.0, 0.0
   while (total_steps < config.num_steps):
     # 訓練模型
+    start = time.time()
     model, optimizer, loss = train(model, optimizer, train_iter, loss_function, total_steps, config.summary_steps, train_dataset, config.num_steps)
+    train_time += time.time() - start
     train_losses += loss
-    # 檢驗模型
-    val_loss, bleu_score, result = test(model, val_loader, loss_function)
+    total_steps += config.summary_steps
+    # 檢驗模型：每次都用同一個子集 (val_subset 為 None 時就是完整的驗證集)，val_losses / bleu_scores 的每個點才能互相比較
+    start = time.time()
+    val_loss, bleu_score, result = test(model, val_subset_loader, loss_function, config.max_output_len - 1, scorer=val_scorer)
     val_losses.append(val_loss)
     bleu_scores.append(bleu_score)
-
-    total_steps += config.summary_steps
-    print ("\r", "val [{}] loss: {:.3f}, Perplexity: {:.3f}, blue score: {:.3f}       ".format(total_steps, val_loss, np.exp(val_loss), bleu_score))
+    sentences = len(result)
+    # 完整驗證集的結果另外存在 full_val (step, loss, bleu)
+    if val_subset is not None and (total_steps >= config.num_steps or total_steps % config.full_val_steps == 0):
+      full_loss, full_bleu, result = test(model, val_loader, loss_function, config.max_output_len - 1, scorer=val_scorer)
+      full_val.append((total_steps, full_loss, full_bleu))
+      print ("\r", "full val [{}] loss: {:.3f}, Perplexity: {:.3f}, blue score: {:.3f}, {} sentences       ".format(
+        total_steps, full_loss, np.exp(full_loss), full_bleu, len(result)))
+    cost = time.time() - start
+    val_time += cost
+
+    print ("\r", "val [{}] loss: {:.3f}, Perplexity: {:.3f}, blue score: {:.3f}, {} sentences in {:.1f}s ({:.1%} of time)       ".format(
+      total_steps, val_loss, np.exp(val_loss), bleu_score, sentences, cost, val_time / (train_time + val_time)))
     
     # 儲存模型和結果
     # if total_steps % config.store_steps == 0 or total_steps >= config.num_steps:
@@ -461,19 +598,19 @@ def train_process(config):
     if total_steps >= config.num_steps:
       save_model(model, optimizer, config.store_model_path, total_steps)
     
-  return train_losses, val_losses, bleu_scores
+  return train_losses, val_losses, bleu_scores, full_val
 
 def test_process(config):
   # 準備測試資料
-  test_dataset = EN2CNDataset(config.data_path, config.max_output_len, 'testing')
-  test_loader = data.DataLoader(test_dataset, batch_size=1)
+  test_dataset = EN2CNDataset(config.data_path, config.max_output_len, 'testing', config.cache_path)
+  test_loader = data.DataLoader(test_dataset, batch_size=1, collate_fn=test_dataset.transform)
   # 建構模型
   model, optimizer = build_model(config, test_dataset.en_vocab_size, test_dataset.cn_vocab_size)
   print ("Finish build model")
   loss_function = nn.CrossEntropyLoss(ignore_index=0)
   model.eval()
   # 測試模型
-  test_loss, bleu_score, result = test(model, test_loader, loss_function)
+  test_loss, bleu_score, result = test(model, test_loader, loss_function, config.max_output_len - 1)
   # 儲存結果
   with open(f'./test_output.txt', 'w') as f:
     for line in result:
@@ -493,11 +630,17 @@ class configurations(object):
     self.num_steps = 12000                # 總訓練次數
     self.store_steps = 300                # 訓練多少次後須儲存模型
     self.summary_steps = 300              # 訓練多少次後須檢驗是否有overfitting
+    self.val_batch_size = 200             # 驗證時的 batch size
+    self.val_subset = 1000                # 每次檢驗只用驗證集中固定的隨機 1000 句 (None 為全部)
+    self.full_val_steps = 3000            # 訓練多少次後用完整的驗證集檢驗
     self.load_model = False               # 是否需載入模型
     self.store_model_path = "./"      # 儲存模型的位置
     self.load_model_path = None           # 載入模型的位置 e.g. "./ckpt/model_{step}" 
     self.data_path = sys.argv[1]          # 資料存放的位置
+    self.cache_path = "./cache"           # 轉成整數的語料 (.npy) 存放的位置
     self.attention = True            # 是否使用 Attention Mechanism
+    self.output_head = 'full'             # 'full': 完整 softmax；'adaptive': 訓練時使用依詞頻分群的 adaptive softmax
+    self.adaptive_cutoffs = (0.1, 0.4)    # adaptive softmax 各群邊界 (佔字典大小的比例)
 
 if __name__ == '__main__':
   # 執行前檢查model path, npy path, attention (true/ false, ff, 取的layer), schedule sampling
@@ -505,7 +648,7 @@ if __name__ == '__main__':
   # print ('config:\n', vars(config))
   # print('schedule sampling: invSig3')
   # print('attention: hidden[0]')
-  train_losses, val_losses, bleu_scores = train_process(config)
+  train_losses, val_losses, bleu_scores, full_val = train_process(config)
   # np.save("./plot/sS_invSig3/train_loss.npy", train_losses)
   # np.save("./plot/sS_invSig3/val_loss.npy", val_losses)
   # np.save("./plot/sS_invSig3/bleu_score.npy", bleu_scores)